@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# Throughput benchmarks for the preprocessing, input pipeline and training
+# steps, run on synthetic fixtures so they need no MIMIC data:
+#
+#   wfdb         records/sec for preprocess_data.wfdb_to_example
+#   reader       records/sec for a wfdb.rdrecord loop against ecg_reader.EcgReader
+#   pipeline     examples/sec for ecg_pipeline.get_dataset over the fixture shards
+#   resnet       train-step latency of the ResNet (ecg_models.resnet_backbone)
+#   transformer  train-step latency of the transformer (ecg_models.transformer_backbone)
+#
+# Each stage also records the process's peak RSS so far. Results are written
+# as JSON named after the current commit, e.g.
+#
+#   python benchmark.py --records 1024 --shard-size 256 --batch-size 64
+#
+# writes data/benchmarks/{commit}-{time}.json; compare two runs' files to
+# spot regressions.
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+import wfdb
+
+from preprocess_data import LAB_COLUMNS, HOSP_COLUMNS, wfdb_to_example, output_file
+from ecg_records import FORMATS, COMPRESSION, NORMALIZATIONS, N_SAMPLES, N_LEADS, record_options
+from ecg_pipeline import get_dataset
+from ecg_models import resnet_backbone, transformer_backbone
+from ecg_training import TRAINING_MODES, set_training_mode
+from ecg_quality import CANONICAL_SIG_ORDER
+from ecg_reader import EcgReader
+
+STAGES = ['wfdb', 'reader', 'pipeline', 'resnet', 'transformer']
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True,
+            text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def synthetic_signal(rng):
+    """A [5000, 12] signal in millivolts: a 72 bpm pulse train plus noise."""
+    t = np.arange(N_SAMPLES) / 500.0
+    beat = np.exp(-((t % (60 / 72)) - 0.2) ** 2 / 0.0005)
+    gain = rng.uniform(0.2, 1.5, N_LEADS)
+    return beat[:, None] * gain + rng.normal(0, 0.05, (N_SAMPLES, N_LEADS))
+
+def make_wfdb_fixtures(path, n_records, seed = 0):
+    """Write n_records synthetic 12-lead 500 Hz WFDB records to path and
+    return the matching {dataset}_ecgs rows with random labels."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_records):
+        name = f"{40000000 + i}"
+        wfdb.wrsamp(name, fs = 500, units = ['mV'] * N_LEADS, sig_name = CANONICAL_SIG_ORDER,
+            p_signal = synthetic_signal(rng), fmt = ['16'] * N_LEADS, adc_gain = [200.0] * N_LEADS,
+            baseline = [0] * N_LEADS, write_dir = str(path))
+        rec = {
+            'path': str(Path(path) / name),
+            'file_name': 40000000 + i,
+            'ecg_age': float(rng.integers(18, 90)),
+            'gender': rng.choice(['M', 'F']),
+        }
+        for label in LAB_COLUMNS + HOSP_COLUMNS:
+            rec[label] = float(rng.normal(4.0, 1.0)) if rng.random() < 0.5 else np.nan
+        rows.append(rec)
+    return rows
+
+def bench_wfdb(rows, path, shard_size, fmt, compression):
+    """Serialize every fixture record and write them as shards of shard_size."""
+    examples = []
+    start = time.perf_counter()
+    for rec in rows:
+        examples.append(wfdb_to_example(rec, fmt))
+    elapsed = time.perf_counter() - start
+
+    files = []
+    for shard, first in enumerate(range(0, len(examples), shard_size)):
+        files.append(output_file(path, "bench", shard))
+        with tf.io.TFRecordWriter(files[-1], record_options(compression)) as writer:
+            for ex in examples[first:first + shard_size]:
+                writer.write(ex)
+
+    result = {
+        'records': len(rows),
+        'seconds': elapsed,
+        'records_per_sec': len(rows) / elapsed,
+        'bytes_per_record': float(np.mean([len(ex) for ex in examples])),
+        'shards': len(files),
+    }
+    return result, files
+
+def bench_reader(rows, index_path, threads):
+    """Read and convert every fixture record to millivolts with a plain
+    rdrecord loop, then with EcgReader before (cold) and after (warm) its
+    header index is written."""
+    paths = [rec['path'] for rec in rows]
+
+    start = time.perf_counter()
+    for path in paths:
+        wfdb.rdrecord(path, physical = False).dac(return_res = 64)
+    rdrecord_rate = len(paths) / (time.perf_counter() - start)
+
+    def _rate(reader):
+        start = time.perf_counter()
+        for r, error in reader.read_many(paths):
+            r.dac()
+        return len(paths) / (time.perf_counter() - start)
+
+    # fixture paths are absolute
+    reader = EcgReader("/", index_path, threads)
+    cold_rate = _rate(reader)
+    reader.save()
+    warm_rate = _rate(EcgReader("/", index_path, threads))
+
+    return {
+        'records': len(paths),
+        'threads': threads,
+        'rdrecord_per_sec': rdrecord_rate,
+        'reader_cold_per_sec': cold_rate,
+        'reader_warm_per_sec': warm_rate,
+        'speedup': warm_rate / rdrecord_rate,
+    }
+
+def bench_pipeline(files, batch_size, fmt, compression, normalize, epochs):
+    dataset = get_dataset(files, 'age', batch_size = batch_size, fmt = fmt, compression = compression,
+        normalize = normalize)
+    epoch_rates = []
+    for _ in range(epochs):
+        count = 0
+        start = time.perf_counter()
+        for x, y in dataset:
+            count += int(y.shape[0])
+        epoch_rates.append(count / (time.perf_counter() - start))
+    # the first epoch includes tracing and file open costs
+    return {
+        'examples': count,
+        'epochs': epochs,
+        'examples_per_sec': epoch_rates,
+        'best_examples_per_sec': max(epoch_rates),
+    }
+
+def build_resnet():
+    input_layer = tf.keras.layers.Input(shape=(N_SAMPLES, N_LEADS))
+    output = tf.keras.layers.Dense(1, dtype = 'float32')(resnet_backbone(input_layer))
+    return tf.keras.models.Model(input_layer, output)
+
+def build_transformer(patch_size, head_size, attention):
+    # the transformer_age1.py model
+    input_layer = tf.keras.layers.Input(shape=(N_SAMPLES, N_LEADS))
+    x = transformer_backbone(input_layer, num_heads=3, patch_size=patch_size, head_size=head_size, attention=attention)
+    x = tf.keras.layers.Dense(1, dtype='float32')(x)
+    return tf.keras.models.Model(input_layer, x)
+
+def bench_step(model, batch_size, jit_compile, warmup, steps, seed = 0):
+    """Per-step latency of train_on_batch on one fixed random batch."""
+    model.compile(optimizer='adam', loss='mse', jit_compile=jit_compile)
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size = (batch_size, N_SAMPLES, N_LEADS)).astype(np.float32)
+    y = rng.uniform(18, 90, size = (batch_size, 1)).astype(np.float32)
+
+    for _ in range(warmup):
+        model.train_on_batch(x, y)
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.train_on_batch(x, y)
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    return {
+        'batch_size': batch_size,
+        'steps': steps,
+        'params': model.count_params(),
+        'step_ms_median': float(np.median(times)),
+        'step_ms_p90': float(np.percentile(times, 90)),
+        'examples_per_sec': batch_size / float(np.median(times)) * 1000,
+    }
+
+def main():
+    parser = ArgumentParser(
+        prog = "benchmark.py",
+        description = "Benchmark preprocessing, the input pipeline and training steps on synthetic data"
+    )
+
+    parser.add_argument("--stages", action = "store", nargs = "+", choices = STAGES, default = STAGES)
+    parser.add_argument("--records", action = "store", type = int, default = 512,
+        help = "number of synthetic WFDB records")
+    parser.add_argument("--shard-size", action = "store", type = int, default = 512)
+    parser.add_argument("--batch-size", action = "store", type = int, default = 64)
+    parser.add_argument("--format", action = "store", choices = FORMATS, default = 'float32')
+    parser.add_argument("--compression", action = "store", choices = COMPRESSION, default = 'NONE')
+    parser.add_argument("--normalize", action = "store", choices = NORMALIZATIONS, default = 'zscore')
+    parser.add_argument("--read-threads", action = "store", type = int, default = 8,
+        help = "EcgReader threads for the reader stage")
+    parser.add_argument("--epochs", action = "store", type = int, default = 3,
+        help = "passes over the fixture shards for the pipeline stage")
+    parser.add_argument("--steps", action = "store", type = int, default = 20,
+        help = "timed training steps per model")
+    parser.add_argument("--warmup", action = "store", type = int, default = 3)
+    parser.add_argument("--step-batch-size", action = "store", type = int, default = 8,
+        help = "batch size for the model step stages")
+    parser.add_argument("--training-mode", action = "store", choices = list(TRAINING_MODES), default = 'float32')
+    parser.add_argument("--patch-size", action = "store", type = int, default = 20,
+        help = "transformer patch size, 0 for full attention over all 5000 timesteps")
+    parser.add_argument("--head-size", action = "store", type = int, default = 64)
+    parser.add_argument("--attention", action = "store", choices = ['full', 'local', 'linear'], default = 'full')
+    parser.add_argument("--workdir", action = "store", help = "where to write fixtures (default: a temporary directory)")
+    parser.add_argument("--output", action = "store", help = "JSON result file (default: data/benchmarks/{commit}-{time}.json)")
+    args = parser.parse_args()
+
+    if args.output is None:
+        stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        args.output = f"data/benchmarks/{git_commit()}-{stamp}.json"
+
+    report = {
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec = "seconds"),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'cpus': os.cpu_count(),
+        'config': vars(args),
+        'results': {},
+    }
+    results = report['results']
+
+    with tempfile.TemporaryDirectory(dir = args.workdir) as workdir:
+        wfdb_path = Path(workdir) / "wfdb"
+        shard_path = Path(workdir) / "tfrecords"
+        wfdb_path.mkdir()
+        shard_path.mkdir()
+
+        files = []
+        if {'wfdb', 'reader', 'pipeline'} & set(args.stages):
+            rows = make_wfdb_fixtures(wfdb_path, args.records)
+
+        if 'reader' in args.stages:
+            results['reader'] = bench_reader(rows, Path(workdir) / "wfdb-headers.parquet", args.read_threads)
+            results['reader']['peak_rss_mb'] = peak_rss_mb()
+            print(f"reader: {results['reader']['reader_warm_per_sec']:0.1f} records/sec, "
+                f"{results['reader']['speedup']:0.1f}x rdrecord")
+
+        if 'wfdb' in args.stages or 'pipeline' in args.stages:
+            results['wfdb'], files = bench_wfdb(rows, shard_path, args.shard_size, args.format, args.compression)
+            results['wfdb']['peak_rss_mb'] = peak_rss_mb()
+            print(f"wfdb: {results['wfdb']['records_per_sec']:0.1f} records/sec")
+
+        if 'pipeline' in args.stages:
+            results['pipeline'] = bench_pipeline(files, args.batch_size, args.format, args.compression,
+                args.normalize, args.epochs)
+            results['pipeline']['peak_rss_mb'] = peak_rss_mb()
+            print(f"pipeline: {results['pipeline']['best_examples_per_sec']:0.1f} examples/sec")
+
+    jit_compile = set_training_mode(args.training_mode)
+    models = {
+        'resnet': build_resnet,
+        'transformer': lambda: build_transformer(args.patch_size, args.head_size, args.attention),
+    }
+    for stage, build in models.items():
+        if stage not in args.stages:
+            continue
+        results[stage] = bench_step(build(), args.step_batch_size, jit_compile, args.warmup, args.steps)
+        results[stage]['peak_rss_mb'] = peak_rss_mb()
+        print(f"{stage}: {results[stage]['step_ms_median']:0.1f} ms/step")
+        tf.keras.backend.clear_session()
+
+    Path(args.output).parent.mkdir(parents = True, exist_ok = True)
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent = 2)
+    print(f"Results: {args.output}")
+
+if __name__ == "__main__":
+    main()
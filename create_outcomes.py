@@ -1,55 +1,121 @@
 #!/usr/bin/env python3
+
+# Build the per-study label tables from the lab and outcome extracts:
+# ecg_lab_results (nearest result per lab) and ecg_hosp_results.
+#
+# With --memory-mb the extracts are streamed in chunks sized for that ceiling
+# instead of being read whole. Each chunk is reduced to its nearest results
+# and merged into the running nearest set, so only the reduced rows (about the
+# size of the output tables) are held across chunks. The outputs are the same
+# as without --memory-mb.
+
 import pandas as pd
 from pathlib import Path
 from datetime import timedelta
+from argparse import ArgumentParser
+
+from ecg_tables import read_table, iter_table, chunk_rows, write_table
 
 BASE_ECG_PATH = Path("/scratch/ajb5d/ecg/mimic-iv-ecg-diagnostic-electrocardiogram-matched-subset-1.0/")
 BASE_DATA_PATH = Path("./data/")
 
-lab_data = pd.read_csv(BASE_DATA_PATH / "lab-results.csv")
-for x in ['charttime', 'ecg_time']:
-    lab_data[x] = pd.to_datetime(lab_data[x])
-
-lab_data['offset'] = (lab_data.charttime - lab_data.ecg_time) / timedelta(minutes=1)
-lab_data['abs_offset'] = lab_data.offset.abs()
-
-results = []
-for target in lab_data.label.unique():
-    results.append(
-        lab_data[lab_data.label == target]
-            .sort_values("abs_offset", ascending = True)
-            .groupby("study_id")
-            .first()
-            [["valuenum", "offset"]]
-            .rename(columns={
-                "valuenum": target.lower(),
-                "offset": f"{target.lower()}_offset"
-            })
+LAB_READ = dict(
+    columns = ["study_id", "label", "valuenum", "charttime", "ecg_time"],
+    dates = ["charttime", "ecg_time"],
+    dtype = {"label": "category"})
+
+OUTCOME_READ = dict(
+    columns = ["study_id", "hadm_id", "hospital_expire_flag", "dischtime", "icu_intime",
+        "icu_outtime", "ecg_time", "ecg_order"],
+    dates = ["dischtime", "icu_intime", "icu_outtime", "ecg_time"])
+
+HOSP_COLUMNS = ["study_id", "hadm_id", "hospital_expire_flag", "icu_expire_flag", "ecg_offset"]
+
+def lab_offsets(lab_data):
+    """Results with a value, with their signed and absolute offset in minutes
+    from the ECG."""
+    lab_data = lab_data.dropna(subset = ["valuenum"])
+    offset = (lab_data.charttime - lab_data.ecg_time) / timedelta(minutes=1)
+    return lab_data[["study_id", "label", "valuenum"]].assign(offset = offset, abs_offset = offset.abs())
+
+def keep_nearest(lab_data):
+    """The result closest to the ECG per (study_id, label). One sort for every
+    label, then the first row per (study, label); equal distances go to the
+    earlier result, and on exact ties to the row that comes first."""
+    return (lab_data
+        .sort_values(["abs_offset", "offset"], ascending = True, kind = "stable")
+        .drop_duplicates(["study_id", "label"]))
+
+def pivot_labs(nearest, labels):
+    """One row per study with a value and offset column per label, in the
+    order labels first appear in the extract."""
+    wide = nearest.pivot(index = "study_id", columns = "label", values = ["valuenum", "offset"])
+
+    result_df = pd.DataFrame(index = wide.index.sort_values())
+    for label in labels:
+        result_df[label.lower()] = wide[("valuenum", label)]
+        result_df[f"{label.lower()}_offset"] = wide[("offset", label)]
+    return result_df
+
+def nearest_labs(lab_data):
+    """For each (study_id, label) keep the result closest in time to the ECG,
+    then pivot to one row per study."""
+    lab_data = lab_offsets(lab_data)
+    return pivot_labs(keep_nearest(lab_data), pd.unique(lab_data.label))
+
+def nearest_labs_chunked(chunks):
+    """nearest_labs over an iterable of lab_data chunks in extract order."""
+    nearest = None
+    labels = {}
+    for chunk in chunks:
+        chunk = lab_offsets(chunk)
+        # plain strings, so chunks with different category sets still concatenate
+        chunk = chunk.assign(label = chunk.label.astype(str))
+        labels.update(dict.fromkeys(pd.unique(chunk.label)))
+        # the running set goes first so earlier rows keep winning exact ties
+        nearest = keep_nearest(pd.concat([nearest, keep_nearest(chunk)], ignore_index = True))
+    return pivot_labs(nearest, list(labels))
+
+def first_outcomes(outcomes_data):
+    """Flags and offsets for each study's first ECG of an admission."""
+    outcomes_data = outcomes_data[(outcomes_data.ecg_order == 1)].copy()
+    outcomes_data['icu_expire_flag'] = (
+        (outcomes_data['icu_outtime'] >= outcomes_data['dischtime']).astype(int)
     )
-    
-result_df = results.pop(0)
-while len(results) > 0:
-    result_df = result_df.join(results.pop(0), how = "outer")
+    outcomes_data['ecg_offset'] = (
+        (outcomes_data['ecg_time'] - outcomes_data['icu_intime']) / timedelta(minutes=1)
+    )
+    return outcomes_data[HOSP_COLUMNS]
+
+def unique_studies(outcomes_data):
+    """Drop studies matched to more than one admission."""
+    study_counts = outcomes_data.study_id.value_counts()
+    return outcomes_data[outcomes_data.study_id.map(study_counts) == 1]
 
-result_df.reset_index().to_csv(BASE_DATA_PATH / "ecg_lab_results.csv", index=False)
+def main():
+    parser = ArgumentParser(
+        prog = "create_outcomes.py",
+        description = "Build the nearest-lab and hospital outcome tables for each ECG study"
+    )
 
-outcomes_data = pd.read_csv(BASE_DATA_PATH / "outcome-results.csv")
-for x in ['admittime', 'dischtime', 'icu_intime', 'icu_outtime', 'ecg_time']:
-    outcomes_data[x] = pd.to_datetime(outcomes_data[x])
+    parser.add_argument("--memory-mb", action = "store", type = float,
+        help = "stream the extracts in chunks sized to stay near this many MB per chunk")
+    args = parser.parse_args()
 
-outcomes_data['icu_expire_flag'] = (
-    (outcomes_data['icu_outtime'] >= outcomes_data['dischtime'])
-        .map(lambda x: 1 if x else 0)
-)
-outcomes_data['ecg_offset'] = (
-    (outcomes_data['ecg_time'] - outcomes_data['icu_intime']) / timedelta(minutes=1)
-)
+    if args.memory_mb is None:
+        lab_results = nearest_labs(read_table(BASE_DATA_PATH, "lab-results", **LAB_READ))
+        outcomes_data = first_outcomes(read_table(BASE_DATA_PATH, "outcome-results", **OUTCOME_READ))
+    else:
+        rows = chunk_rows(args.memory_mb, BASE_DATA_PATH, "lab-results", **LAB_READ)
+        lab_results = nearest_labs_chunked(iter_table(BASE_DATA_PATH, "lab-results", chunk_rows = rows, **LAB_READ))
 
-outcomes_data = outcomes_data[(outcomes_data.ecg_order == 1)]
+        rows = chunk_rows(args.memory_mb, BASE_DATA_PATH, "outcome-results", **OUTCOME_READ)
+        outcomes_data = pd.concat([first_outcomes(chunk)
+            for chunk in iter_table(BASE_DATA_PATH, "outcome-results", chunk_rows = rows, **OUTCOME_READ)],
+            ignore_index = True)
 
-study_counts = outcomes_data.study_id.value_counts()
-good_studys = list(study_counts[study_counts == 1].index) 
-outcomes_data = outcomes_data[outcomes_data.study_id.isin(good_studys)]
+    write_table(lab_results.reset_index(), BASE_DATA_PATH, "ecg_lab_results")
+    write_table(unique_studies(outcomes_data), BASE_DATA_PATH, "ecg_hosp_results")
 
-outcomes_data[["study_id", "hadm_id", "hospital_expire_flag",
-    "icu_expire_flag", "ecg_offset"]].to_csv(BASE_DATA_PATH / "ecg_hosp_results.csv", index=False)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,190 @@
 #!/usr/bin/env python3
 
+# Assign every ECG to train, val or test by subject and write the record list
+# once, with the assignment in a 'split' column (and optionally a
+# cross-validation 'fold' column), as the ecgs table.
+#
+# Each subject's split comes from a keyed hash of its subject_id, so a subject
+# always lands in the same split and new ECGs or subjects never move existing
+# ones. With --stratify the hash values are replaced by their rank within each
+# age band / sex stratum, which gives exact proportions per stratum but can
+# move subjects when the cohort changes.
+#
+# The hash assignment does not reproduce the train_test_split assignment of
+# the per-split {dataset}_ecgs tables written before it: about 2/3 of the
+# subjects change split, so models trained on the old train split would be
+# scored on some of their training subjects. --keep-splits keeps the split
+# every known subject had in the previous run (the existing ecgs table, or
+# the old {dataset}_ecgs tables) and hashes only new subjects; use it to keep
+# evaluating existing models, and leave it off for a one-time reassignment.
+#
+# With --memory-mb the record list is streamed in chunks sized for that
+# ceiling and the ecgs table is written chunk by chunk; only the patients
+# table and, with --stratify, one row per subject are held whole. The output
+# is the same as without --memory-mb.
+
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from argparse import ArgumentParser
+
+from ecg_tables import read_table, iter_table, chunk_rows, write_table, write_table_chunks
 
 BASE_ECG_PATH = Path("/scratch/ajb5d/ecg/mimic-iv-ecg-diagnostic-electrocardiogram-matched-subset-1.0/")
 BASE_DATA_PATH = Path("./data/")
 
-patients = pd.read_csv(BASE_DATA_PATH / "mimic"/ "patients.csv")
-patients.set_index('subject_id', inplace=True)
+# changing the key reshuffles every subject; pd.util.hash_array needs 16 characters
+SPLIT_KEY = "ecg-split-key-v1"
+TEST_FRACTION = 0.2
+VAL_FRACTION = 0.2  # of the subjects that are not in test
+AGE_BANDS = [0, 40, 60, 80, np.inf]
+SPLITS = ['train', 'val', 'test']
+
+def subject_hash(subject_ids, key = SPLIT_KEY):
+    """A uniform value in [0, 1) per subject id, the same on every run."""
+    h = pd.util.hash_array(np.asarray(subject_ids, dtype = np.int64), hash_key = key, categorize = False)
+    return (h >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+def stratified_rank(u, strata):
+    """Replace u with its rank quantile (rank + 0.5) / n within each stratum."""
+    u = pd.Series(u)
+    groups = u.groupby(strata, dropna = False)
+    return ((groups.rank(method = "first") - 0.5) / groups.transform("size")).values
+
+def assign_splits(u, test_fraction = TEST_FRACTION, val_fraction = VAL_FRACTION, folds = 0):
+    """Split names for values u in [0, 1) and, if folds > 0, a fold number in
+    [0, folds) for train and val subjects (-1 for test)."""
+    val_cut = test_fraction + (1 - test_fraction) * val_fraction
+    split = np.where(u < test_fraction, 'test', np.where(u < val_cut, 'val', 'train'))
+    if not folds:
+        return split, None
+    v = (u - test_fraction) / (1 - test_fraction)
+    fold = np.where(u < test_fraction, -1, np.minimum((v * folds).astype(int), folds - 1))
+    return split, fold
+
+RECORD_READ = dict(columns = ['subject_id', 'study_id', 'file_name', 'ecg_time', 'path'], dates = ['ecg_time'])
+
+def attach_patients(ecg_data, patients):
+    """Join patient demographics to ECG rows and compute the age at each ECG."""
+    ecg_data = ecg_data.join(patients, on='subject_id', how='left')
+    ecg_data['age_delta'] = ecg_data['ecg_time'].dt.year - ecg_data['anchor_year']
+    ecg_data['ecg_age'] = ecg_data['age_delta'] + ecg_data['anchor_age']
+    return ecg_data
+
+def subject_table(ecg_data):
+    """Sex and age at the first ECG per subject."""
+    return ecg_data.groupby('subject_id', observed = True).agg(gender = ('gender', 'first'), age = ('ecg_age', 'min'))
+
+def merge_subject_tables(tables):
+    """subject_table of a whole record list from the tables of its chunks, in order."""
+    return pd.concat(tables).groupby(level = 0).agg(gender = ('gender', 'first'), age = ('age', 'min'))
+
+def previous_splits(base_path):
+    """Split per subject from the previous run: the ecgs table, or else the
+    {dataset}_ecgs tables from before it. None if there is neither."""
+    try:
+        ecgs = read_table(base_path, "ecgs", columns = ['subject_id', 'split'])
+    except FileNotFoundError:
+        parts = []
+        for dataset in SPLITS:
+            try:
+                parts.append(read_table(base_path, f"{dataset}_ecgs", columns = ['subject_id']).assign(split = dataset))
+            except FileNotFoundError:
+                pass
+        if not parts:
+            return None
+        ecgs = pd.concat(parts)
+    return ecgs.drop_duplicates('subject_id').set_index('subject_id')['split'].astype(str)
+
+def subject_splits(subjects, args, keep = None):
+    """Split and fold (or None) per subject, indexed like subjects. Subjects
+    in keep (subject_id -> split) keep that split."""
+    u = subject_hash(subjects.index)
+
+    strata = []
+    if 'age' in args.stratify:
+        strata.append(pd.cut(subjects['age'], AGE_BANDS, right = False).values)
+    if 'sex' in args.stratify:
+        strata.append(subjects['gender'].values)
+    if strata:
+        u = stratified_rank(u, strata)
+
+    split, fold = assign_splits(u, args.test_fraction, args.val_fraction, args.folds)
+    split = pd.Series(split, index = subjects.index)
+    if keep is not None:
+        split = keep.reindex(subjects.index).fillna(split)
+    return split, None if fold is None else pd.Series(fold, index = subjects.index)
+
+def label_splits(ecg_data, subject_split, subject_fold):
+    ecg_data['split'] = pd.Categorical(ecg_data['subject_id'].map(subject_split), categories = ['train', 'val', 'test'])
+    if subject_fold is not None:
+        ecg_data['fold'] = ecg_data['subject_id'].map(subject_fold).astype(np.int8)
+    return ecg_data
+
+def chunked_ecgs(chunks, patients, args, subjects = None, keep = None):
+    """Labelled ecgs table chunks. Without stratification a subject's split
+    depends only on its id, so each chunk is assigned on its own."""
+    assigned = None if subjects is None else subject_splits(subjects, args, keep)
+    for chunk in chunks:
+        chunk = attach_patients(chunk, patients)
+        if subjects is None:
+            assigned = subject_splits(pd.DataFrame(index = pd.Index(chunk['subject_id'].unique())), args, keep)
+        yield label_splits(chunk, *assigned)
 
-ecg_data = pd.read_csv(BASE_ECG_PATH / "record_list.csv")
-ecg_data['ecg_time'] = pd.to_datetime(ecg_data['ecg_time'])
-ecg_data = ecg_data.join(patients, on='subject_id', how='left')
+def main():
+    parser = ArgumentParser(
+        prog = "create_test_train_split.py",
+        description = "Assign ECGs to train/val/test by subject"
+    )
 
-ecg_data['age_delta'] = ecg_data['ecg_time'].dt.year - ecg_data['anchor_year']
-ecg_data['ecg_age'] = ecg_data['age_delta'] + ecg_data['anchor_age']
+    parser.add_argument("--test-fraction", action = "store", type = float, default = TEST_FRACTION)
+    parser.add_argument("--val-fraction", action = "store", type = float, default = VAL_FRACTION,
+        help = "fraction of the non-test subjects used for validation")
+    parser.add_argument("--stratify", action = "store", nargs = "+", choices = ['age', 'sex'], default = [],
+        help = "balance splits within age bands (at the first ECG) and/or sex")
+    parser.add_argument("--folds", action = "store", type = int, default = 0,
+        help = "also assign train and val subjects to this many cross-validation folds "
+            "(with the default fractions, fold 0 of 5 is the val split)")
+    parser.add_argument("--memory-mb", action = "store", type = float,
+        help = "stream the record list in chunks sized to stay near this many MB per chunk")
+    parser.add_argument("--keep-splits", action = "store_true",
+        help = "keep the split of every subject in the previous ecgs or {dataset}_ecgs tables; hash only new subjects")
+    args = parser.parse_args()
+    if args.keep_splits and (args.stratify or args.folds):
+        parser.error("--keep-splits cannot be combined with --stratify or --folds")
 
-all_patients = ecg_data['subject_id'].unique()
+    previous = previous_splits(BASE_DATA_PATH)
+    keep = previous if args.keep_splits else None
+    if args.keep_splits:
+        print(f"Keeping the splits of {0 if previous is None else len(previous)} subjects from the previous run")
+    elif previous is not None and not args.stratify:
+        moved = (subject_splits(pd.DataFrame(index = previous.index), args)[0] != previous).mean()
+        if moved:
+            print(f"Warning: {moved:.0%} of the subjects in the previous run change split (see --keep-splits)")
 
-from sklearn.model_selection import train_test_split
+    # float ages, so every chunk has the same dtypes whether or not all of its
+    # subjects are in patients
+    patients = read_table(BASE_DATA_PATH / "mimic", "patients", dates = ['dod'],
+        dtype = {'gender': 'category', 'anchor_year_group': 'category',
+            'anchor_age': 'float64', 'anchor_year': 'float64'})
+    patients.set_index('subject_id', inplace=True)
 
-trainval_patients, test_patients = train_test_split(all_patients, test_size=0.2, random_state=42)
-train_patients, val_patients = train_test_split(trainval_patients, test_size=0.2, random_state=42)
+    if args.memory_mb is None:
+        ecg_data = attach_patients(read_table(BASE_ECG_PATH, "record_list", **RECORD_READ), patients)
+        subjects = subject_table(ecg_data)
+        write_table(label_splits(ecg_data, *subject_splits(subjects, args, keep)), BASE_DATA_PATH, 'ecgs')
+    else:
+        rows = chunk_rows(args.memory_mb, BASE_ECG_PATH, "record_list", **RECORD_READ)
+        chunks = lambda: iter_table(BASE_ECG_PATH, "record_list", chunk_rows = rows, **RECORD_READ)
+        subjects = None
+        if args.stratify:
+            # a first pass for each subject's sex and age at the first ECG
+            subjects = merge_subject_tables([subject_table(attach_patients(chunk, patients))
+                for chunk in chunks()])
+        write_table_chunks(chunked_ecgs(chunks(), patients, args, subjects, keep), BASE_DATA_PATH, 'ecgs')
 
+    ecg_data = read_table(BASE_DATA_PATH, 'ecgs', columns = ['subject_id', 'study_id', 'split'])
+    print(ecg_data.groupby('split', observed = True).agg(ecgs = ('study_id', 'size'), subjects = ('subject_id', 'nunique')))
 
-ecg_data[ecg_data['subject_id'].isin(train_patients)].to_csv(BASE_DATA_PATH / 'train_ecgs.csv', index=False)
-ecg_data[ecg_data['subject_id'].isin(test_patients)].to_csv(BASE_DATA_PATH / 'test_ecgs.csv', index=False)
-ecg_data[ecg_data['subject_id'].isin(val_patients)].to_csv(BASE_DATA_PATH / 'val_ecgs.csv', index=False)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
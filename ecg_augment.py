@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Batched cropping, resampling and augmentation of decoded ECG batches, run
+# in the input pipeline after batching (see ecg_pipeline.get_dataset):
+#
+#   augment = augment_config(crop_seconds = 2.5, sample_rate = 250, lead_dropout = 0.1, jitter = 0.1)
+#   train_dataset = get_dataset(TRAIN_RECS, 'age', augment = augment)
+#   val_dataset = get_dataset(VAL_RECS, 'age', augment = augment, shuffle = False)
+#   input_layer = tf.keras.layers.Input(shape = input_shape(augment))
+#
+# crop_seconds   take a window of this length: random in training, the
+#                center one otherwise (None keeps all 10 s)
+# sample_rate    low-pass filter and decimate from 500 Hz to this rate
+# lead_dropout   in training, zero each lead with this probability (at least
+#                one lead is always kept)
+# jitter         in training, scale each lead by exp(N(0, jitter))
+#
+# Decoded batches are lead-major samples reshaped to [5000, 12] (see
+# ecg_records.decode_signal), so the stage works on the [time, lead] signal
+# and returns it in that same layout: a model sees the same arrangement with
+# or without augmentation, only with fewer samples. multi_crop gives the
+# evenly spaced crops score_ecgs.py averages over at test time; training
+# scripts save the config to augment_file so scoring uses the same inputs.
+
+import json
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+
+from ecg_records import N_SAMPLES, N_LEADS
+
+SAMPLING_RATE = 500
+AUGMENT_DEFAULTS = {
+    'crop_seconds': None,
+    'sample_rate': SAMPLING_RATE,
+    'lead_dropout': 0.0,
+    'jitter': 0.0,
+}
+# decimation filter taps per unit of decimation factor
+FILTER_TAPS = 8
+
+def augment_config(**kwargs):
+    """An augmentation config: AUGMENT_DEFAULTS updated with kwargs."""
+    unknown = set(kwargs) - set(AUGMENT_DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown augmentation options: {', '.join(sorted(unknown))}")
+    config = dict(AUGMENT_DEFAULTS, **{k: v for k, v in kwargs.items() if v is not None})
+    if SAMPLING_RATE % config['sample_rate']:
+        raise ValueError(f"sample_rate must divide {SAMPLING_RATE} Hz, got {config['sample_rate']}")
+    if config['crop_seconds'] is not None and not 0 < crop_samples(config) <= N_SAMPLES:
+        raise ValueError(f"crop_seconds must be in (0, {N_SAMPLES / SAMPLING_RATE:g}], got {config['crop_seconds']}")
+    return config
+
+def crop_samples(config):
+    """Window length in 500 Hz samples."""
+    if config['crop_seconds'] is None:
+        return N_SAMPLES
+    return int(round(config['crop_seconds'] * SAMPLING_RATE))
+
+def decimation(config):
+    return SAMPLING_RATE // config['sample_rate']
+
+def input_shape(config):
+    """The (samples, leads) shape augment_batch produces, for the model input."""
+    return (-(-crop_samples(config) // decimation(config)), N_LEADS)
+
+def augment_file(model_dir, model_name):
+    """Where a model's augmentation config is saved, next to {model_name}.keras."""
+    return Path(model_dir) / f"{model_name}-augment.json"
+
+def save_config(path, config):
+    with open(path, "w") as fh:
+        json.dump(config, fh, indent = 2)
+
+def load_config(path):
+    with open(path) as fh:
+        return augment_config(**json.load(fh))
+
+def to_time_major(x):
+    """Pipeline layout [B, 5000, 12] to the [B, time, lead] signal."""
+    return tf.transpose(tf.reshape(x, [-1, N_LEADS, tf.shape(x)[1]]), [0, 2, 1])
+
+def to_pipeline_layout(x):
+    """[B, time, lead] back to lead-major samples reshaped to [B, time, 12]."""
+    return tf.reshape(tf.transpose(x, [0, 2, 1]), [-1, tf.shape(x)[1], N_LEADS])
+
+def crop(x, offsets, window):
+    """[B, window, 12] windows of [B, time, 12] starting at offsets [B]."""
+    index = offsets[:, None] + tf.range(window)[None, :]
+    return tf.gather(x, index, batch_dims = 1)
+
+def lowpass_kernel(factor):
+    """Hamming-windowed sinc low-pass with its cutoff at the new Nyquist rate."""
+    n = FILTER_TAPS * factor + 1
+    t = np.arange(n) - (n - 1) / 2
+    h = np.sinc(t / factor) * np.hamming(n)
+    return (h / h.sum()).astype(np.float32)
+
+def decimate(x, factor):
+    """Low-pass filter each lead of [B, time, 12] and keep every factor-th sample."""
+    if factor == 1:
+        return x
+    kernel = tf.constant(np.tile(lowpass_kernel(factor)[:, None, None, None], [1, 1, N_LEADS, 1]))
+    y = tf.nn.depthwise_conv2d(x[:, :, None, :], kernel, strides = [1, factor, 1, 1], padding = 'SAME')
+    return y[:, :, 0, :]
+
+def lead_dropout(x, rate):
+    keep = tf.random.uniform([tf.shape(x)[0], 1, N_LEADS]) >= rate
+    keep = keep | ~tf.reduce_any(keep, axis = -1, keepdims = True)
+    return x * tf.cast(keep, x.dtype)
+
+def amplitude_jitter(x, sigma):
+    return x * tf.exp(tf.random.normal([tf.shape(x)[0], 1, N_LEADS], stddev = sigma))
+
+def augment_batch(x, config, training = True):
+    """Crop, decimate and (in training) augment a decoded [B, 5000, 12] batch."""
+    x = to_time_major(x)
+    window = crop_samples(config)
+    if window < N_SAMPLES:
+        batch = tf.shape(x)[0]
+        if training:
+            offsets = tf.random.uniform([batch], 0, N_SAMPLES - window + 1, dtype = tf.int32)
+        else:
+            offsets = tf.fill([batch], (N_SAMPLES - window) // 2)
+        x = crop(x, offsets, window)
+    x = decimate(x, decimation(config))
+    if training and config['lead_dropout']:
+        x = lead_dropout(x, config['lead_dropout'])
+    if training and config['jitter']:
+        x = amplitude_jitter(x, config['jitter'])
+    return tf.ensure_shape(to_pipeline_layout(x), [None, *input_shape(config)])
+
+def multi_crop(x, config, crops):
+    """[crops, B, samples, 12]: evenly spaced crops of a decoded batch,
+    cropped and decimated as augment_batch does without augmentation."""
+    x = to_time_major(x)
+    window = crop_samples(config)
+    starts = np.linspace(0, N_SAMPLES - window, crops).round().astype(np.int32) if crops > 1 else [(N_SAMPLES - window) // 2]
+    batch = tf.shape(x)[0]
+    crops = tf.stack([to_pipeline_layout(decimate(crop(x, tf.fill([batch], int(start)), window), decimation(config)))
+        for start in starts])
+    return tf.ensure_shape(crops, [len(starts), None, *input_shape(config)])
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Model building blocks shared by the training scripts.
+
+import tensorflow as tf
+from tensorflow.keras import layers
+from datetime import datetime
+import os
+
+def make_checkpoint_dir(data_path, label):
+    current_datetime = datetime.now()
+    formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
+    output_dir = f"{label}-{formatted_datetime}"
+    output_path = f"{data_path}/{output_dir}"
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    return output_path
+
+## Resnet from https://github.com/antonior92/automatic-ecg-diagnosis/tree/master
+## https://www.nature.com/articles/s41467-020-15432-4
+
+def residual_unit(x, y, n_samples_out, n_filters_out, prefix, kernel_size = 16):
+    n_samples_in = y.shape[1]
+    # shorter (cropped or decimated) inputs are not downsampled below n_samples_out
+    downsample = max(n_samples_in // n_samples_out, 1)
+    n_filters_in = y.shape[2]
+
+    if downsample == 1:
+        y = y
+    else:
+        y = layers.MaxPooling1D(downsample, strides=downsample, padding='same', name = f"{prefix}_mp_opt")(y)
+
+    if n_filters_in != n_filters_out:
+        y = layers.Conv1D(n_filters_out, 1, padding='same', use_bias=False, name = f"{prefix}_conv_opt")(y)
+
+    x = layers.Conv1D(n_filters_out, kernel_size, padding='same', use_bias=False, name = f"{prefix}_conv1")(x)
+    x = layers.BatchNormalization(name = f"{prefix}_bn1")(x)
+    x = layers.Activation("relu", name = f"{prefix}_act1")(x)
+    x = layers.Dropout(0.2, name = f"{prefix}_dropout1")(x)
+    x = layers.Conv1D(n_filters_out, kernel_size, strides=downsample, padding='same', use_bias=False, name = f"{prefix}_conv2")(x)
+
+    x = layers.Add(name = f"{prefix}_add")([x,y])
+    y = x
+    x = layers.BatchNormalization(name = f"{prefix}_bn2")(x)
+    x = layers.Activation("relu", name = f"{prefix}_act2")(x)
+    x = layers.Dropout(0.2, name = f"{prefix}_dropout2")(x)
+    return (x,y)
+
+def resnet_backbone(input_layer):
+    """The exp_resnet_* feature extractor, ending in the flattened features."""
+    x = layers.Conv1D(64, 16, padding='same', use_bias=False, name = "conv_1")(input_layer)
+    x = layers.BatchNormalization(name="bn")(x)
+    x = layers.Activation("relu", name="relu")(x)
+
+    x, y = residual_unit(x,x,1024,128, "res1")
+    x, y = residual_unit(x,y,256,196, "res2")
+    x, y = residual_unit(x,y,64,256, "res3")
+    x, _ = residual_unit(x,y,16,320, "res4")
+
+    return layers.Flatten(name="flatten")(x)
+
+#https://keras.io/examples/timeseries/timeseries_transformer_classification/
+#
+# attention = 'full' is the original MultiHeadAttention over every timestep,
+# O(L^2) memory. 'local' attends within non-overlapping windows of `window`
+# steps, O(L * window). 'linear' uses kernelized linear attention, O(L).
+def transformer_encoder(inputs, head_size, num_heads, ff_dim, dropout=0, attention='full', window=250):
+    x = tf.keras.layers.LayerNormalization(epsilon=1e-6)(inputs)
+    if attention == 'full':
+        x = tf.keras.layers.MultiHeadAttention(key_dim=head_size, num_heads=num_heads,dropout=dropout)(x,x)
+    elif attention == 'local':
+        x = LocalAttention(key_dim=head_size, num_heads=num_heads, window=window, dropout=dropout)(x)
+    elif attention == 'linear':
+        x = LinearAttention(key_dim=head_size, num_heads=num_heads)(x)
+    else:
+        raise ValueError(f"unknown attention type: {attention}")
+    x = tf.keras.layers.Dropout(dropout)(x)
+    res = x + inputs
+
+    x = tf.keras.layers.LayerNormalization(epsilon=1e-6)(res)
+    x = tf.keras.layers.Conv1D(filters=ff_dim, kernel_size=1, activation='relu')(x)
+    x = tf.keras.layers.Dropout(dropout)(x)
+    x = tf.keras.layers.Conv1D(filters=inputs.shape[-1], kernel_size=1)(x)
+    return x + res
+
+def transformer_backbone(input_layer, num_heads, patch_size=0, embed_dim=64, head_size=5000, attention='full',
+        window=250):
+    """The transformer_age*.py feature extractor: an optional patch embedding,
+    one encoder block and the dense layers before the output."""
+    x = input_layer
+    if patch_size:
+        x = patch_embedding(x, patch_size, embed_dim)
+    x = transformer_encoder(x, head_size=head_size, num_heads=num_heads, ff_dim=4*x.shape[-1], dropout=0,
+        attention=attention, window=window)
+    x = tf.keras.layers.MaxPooling1D()(x)
+
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dense(128)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Activation('relu')(x)
+    x = tf.keras.layers.Dropout(0.5)(x)
+    x = tf.keras.layers.Dense(64)(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Activation('relu')(x)
+    x = tf.keras.layers.Dropout(0.5)(x)
+    return x
+
+def patch_embedding(x, patch_size, embed_dim):
+    """Strided convolution front end: [B, 5000, 12] -> [B, 5000 / patch_size, embed_dim]."""
+    return tf.keras.layers.Conv1D(embed_dim, patch_size, strides=patch_size, padding='same', name="patch_embedding")(x)
+
+@tf.keras.utils.register_keras_serializable(package="ecg")
+class LocalAttention(tf.keras.layers.Layer):
+    def __init__(self, key_dim, num_heads, window, dropout=0, **kwargs):
+        super().__init__(**kwargs)
+        self.key_dim = key_dim
+        self.num_heads = num_heads
+        self.window = window
+        self.dropout = dropout
+        self.attention = tf.keras.layers.MultiHeadAttention(key_dim=key_dim, num_heads=num_heads, dropout=dropout)
+
+    def call(self, x, training=None):
+        length = tf.shape(x)[1]
+        channels = x.shape[-1]
+        pad = (-length) % self.window
+        x_pad = tf.pad(x, [[0, 0], [0, pad], [0, 0]])
+        # fold the windows into the batch so attention is window x window
+        blocks = tf.reshape(x_pad, [-1, self.window, channels])
+        # padded positions are masked as keys; pad < window, so every window
+        # keeps at least one real key
+        valid = tf.reshape(tf.range(length + pad) < length, [1, -1, 1, self.window])
+        valid = tf.tile(valid, [tf.shape(x)[0], 1, self.window, 1])
+        mask = tf.reshape(valid, [-1, self.window, self.window])
+        blocks = self.attention(blocks, blocks, attention_mask=mask, training=training)
+        out = tf.reshape(blocks, [tf.shape(x)[0], length + pad, channels])
+        return out[:, :length, :]
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(key_dim=self.key_dim, num_heads=self.num_heads, window=self.window, dropout=self.dropout)
+        return config
+
+@tf.keras.utils.register_keras_serializable(package="ecg")
+class LinearAttention(tf.keras.layers.Layer):
+    """Linear attention (Katharopoulos et al. 2020) with an elu + 1 feature map."""
+
+    def __init__(self, key_dim, num_heads, **kwargs):
+        super().__init__(**kwargs)
+        self.key_dim = key_dim
+        self.num_heads = num_heads
+
+    def build(self, input_shape):
+        width = self.key_dim * self.num_heads
+        self.query = tf.keras.layers.Dense(width, use_bias=False)
+        self.key = tf.keras.layers.Dense(width, use_bias=False)
+        self.value = tf.keras.layers.Dense(width, use_bias=False)
+        self.output_dense = tf.keras.layers.Dense(input_shape[-1])
+        for layer in (self.query, self.key, self.value):
+            layer.build(input_shape)
+        self.output_dense.build(tuple(input_shape[:-1]) + (width,))
+        super().build(input_shape)
+
+    def _heads(self, x):
+        return tf.reshape(x, [tf.shape(x)[0], tf.shape(x)[1], self.num_heads, self.key_dim])
+
+    def call(self, x):
+        q = tf.nn.elu(self._heads(self.query(x))) + 1.0
+        k = tf.nn.elu(self._heads(self.key(x))) + 1.0
+        v = self._heads(self.value(x))
+
+        kv = tf.einsum('blhd,blhe->bhde', k, v)
+        norm = 1.0 / (tf.einsum('blhd,bhd->blh', q, tf.reduce_sum(k, axis=1)) + 1e-6)
+        out = tf.einsum('blhd,bhde,blh->blhe', q, kv, norm)
+        out = tf.reshape(out, [tf.shape(x)[0], tf.shape(x)[1], self.num_heads * self.key_dim])
+        return self.output_dense(out)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(key_dim=self.key_dim, num_heads=self.num_heads)
+        return config
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Shared tf.data input pipeline for the training scripts and notebooks.
+#
+#   from ecg_pipeline import get_dataset
+#
+#   train_dataset = get_dataset(TRAIN_RECS, 'age', max_value = 90.0)
+#   val_dataset = get_dataset(VAL_RECS, 'age', max_value = 90.0, shuffle = False)
+#
+# Shards are read with a parallel interleave, serialized examples are parsed a
+# batch at a time with parse_example, label filtering is a boolean mask over
+# each parsed batch, and batches are prefetched after batching.
+#
+# Signals are normalized while decoding each parsed batch (see ecg_records.py
+# for the methods). 'global' needs the training set's per-lead statistics:
+#
+#   stats = dataset_stats(TRAIN_RECS)
+#   train_dataset = get_dataset(TRAIN_RECS, 'age', normalize = 'global', global_stats = stats)
+#
+# augment (an ecg_augment.augment_config) crops, resamples and augments each
+# batch after batching, so it is applied fresh every epoch, after any cache.
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from ecg_augment import augment_batch
+from ecg_records import N_SAMPLES, N_LEADS, signal_record_format, decode_signal, stats_record_format, pooled_stats, load_index
+
+FEATURE_TYPES = {
+    'age': tf.float32,
+    'gender': tf.int64,
+    'file_name': tf.int64,
+    'troponin i': tf.float32,
+    'troponin i_offset': tf.float32,
+    'potassium': tf.float32,
+    'potassium_offset': tf.float32,
+    'sodium': tf.float32,
+    'sodium_offset': tf.float32,
+    'hospital_expire_flag': tf.float32,
+    'icu_expire_flag': tf.float32,
+    'ecg_offset': tf.float32,
+}
+
+DEFAULT_SHUFFLE_BUFFER = 8192
+PARSE_BATCH_SIZE = 256
+
+# cache = 'auto' keeps the decoded dataset in memory if its estimated size is
+# below this fraction of the available memory, and on disk otherwise
+CACHE_MEMORY_FRACTION = 0.5
+DEFAULT_CACHE_DIR = "data/cache"
+# bump when the parsed output changes so old on-disk caches are not reused
+CACHE_VERSION = 1
+
+def feature_spec(features, fmt = 'float32'):
+    spec = signal_record_format(fmt)
+    for f in features:
+        spec[f] = tf.io.FixedLenFeature([], FEATURE_TYPES[f])
+    return spec
+
+def parse_batch(records, features, fmt = 'float32', normalize = 'zscore', global_stats = None):
+    """Parse a batch of serialized examples to (ecg [B, 5000, 12], {feature: [B]})."""
+    example = tf.io.parse_example(records, feature_spec(features, fmt))
+    return decode_signal(example, fmt, normalize, global_stats), {f: example[f] for f in features}
+
+def label_mask(values, require = (), min_value = None, max_value = None, label = None):
+    """Boolean mask over a parsed batch: required features are not NaN and the
+    label lies in [min_value, max_value]."""
+    mask = tf.ones_like(values[next(iter(values))], dtype = tf.bool)
+    for f in require:
+        if values[f].dtype.is_floating:
+            mask = mask & tf.logical_not(tf.math.is_nan(values[f]))
+    if min_value is not None:
+        mask = mask & (values[label] >= min_value)
+    if max_value is not None:
+        mask = mask & (values[label] <= max_value)
+    return mask
+
+def indexed_counts(filenames):
+    """Record count of each of filenames from the indexes preprocess_data.py
+    writes next to them, so the number of examples is known without reading
+    the shards; None if a file is not indexed or changed since."""
+    entries = {}
+    for directory in {Path(f).parent for f in filenames}:
+        for path in directory.glob("*-index.json"):
+            for s in load_index(directory, path.name[:-len("-index.json")])['shards']:
+                entries[directory / s['file']] = s
+    counts = []
+    for f in map(Path, filenames):
+        entry = entries.get(f)
+        if entry is None or entry['bytes'] != os.stat(f).st_size:
+            return None
+        counts.append(entry['records'])
+    return counts
+
+def read_records(filenames, compression = 'NONE', shuffle_files = False, interleave = 8, deterministic = False):
+    files = tf.data.Dataset.from_tensor_slices([str(f) for f in filenames])
+    if shuffle_files:
+        files = files.shuffle(len(filenames), reshuffle_each_iteration = True)
+    return files.interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type = "" if compression == 'NONE' else compression),
+        cycle_length = interleave,
+        num_parallel_calls = tf.data.AUTOTUNE,
+        deterministic = deterministic)
+
+def parse_time(filenames, features = (), fmt = 'float32', compression = 'NONE', normalize = 'zscore',
+        global_stats = None, batches = 4):
+    """Seconds per example spent in parse_batch, timed on one thread over up
+    to `batches` batches of PARSE_BATCH_SIZE records from the first file,
+    after a warm-up batch. Reading the records is not included."""
+    records = list(read_records(filenames[:1], compression).batch(PARSE_BATCH_SIZE).take(batches + 1))
+    parse = tf.function(lambda r: parse_batch(r, list(features), fmt, normalize, global_stats))
+    parse(records[0])
+    timed = records[1:] or records
+    start = time.perf_counter()
+    for r in timed:
+        parse(r)
+    return (time.perf_counter() - start) / sum(len(r) for r in timed)
+
+def dataset_stats(filenames, compression = 'NONE'):
+    """Per-lead (mean, std) over every record in filenames, pooled from the
+    stored per-record statistics without decoding any signal."""
+    spec = stats_record_format()
+    dataset = read_records(filenames, compression, deterministic = True).batch(16 * PARSE_BATCH_SIZE)
+    dataset = dataset.map(lambda r: tf.io.parse_example(r, spec), num_parallel_calls = tf.data.AUTOTUNE)
+    means, stds = [], []
+    for stats in dataset:
+        means.append(stats['ecg/mean'].numpy())
+        stds.append(stats['ecg/std'].numpy())
+    return pooled_stats(np.concatenate(means), np.concatenate(stds))
+
+def load_dataset(filenames, label, inputs = (), require = None, min_value = None, max_value = None,
+        fmt = 'float32', compression = 'NONE', shuffle_files = False, interleave = 8, deterministic = False,
+        normalize = 'zscore', global_stats = None):
+    """Unbatched (x, y) examples that pass the label filters.
+
+    x is the [5000, 12] ECG, or a tuple (ecg, *inputs) when extra model inputs
+    are requested. require defaults to the label and any float inputs.
+    normalize and global_stats are passed to ecg_records.decode_signal.
+    """
+    inputs = list(inputs)
+    features = [label] + [f for f in inputs if f != label]
+    if require is None:
+        require = features
+
+    def _parse(records):
+        ecg, values = parse_batch(records, features, fmt, normalize, global_stats)
+        mask = label_mask(values, require, min_value, max_value, label)
+        ecg = tf.boolean_mask(ecg, mask)
+        values = {f: tf.boolean_mask(v, mask) for f, v in values.items()}
+        x = (ecg, *[values[f] for f in inputs]) if inputs else ecg
+        return x, values[label]
+
+    dataset = read_records(filenames, compression, shuffle_files, interleave, deterministic)
+    dataset = dataset.batch(PARSE_BATCH_SIZE)
+    dataset = dataset.map(_parse, num_parallel_calls = tf.data.AUTOTUNE, deterministic = deterministic)
+    return dataset.unbatch()
+
+def _file_identity(filenames):
+    return [(str(Path(f).resolve()), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in sorted(map(str, filenames))]
+
+def cache_file(cache_dir, filenames, labels, params):
+    """On-disk cache prefix for a parsed dataset.
+
+    The name is {labels}-{shards}-{params}-{state}, hashing the shard paths,
+    the parameters that change what is parsed, and the shards' sizes and
+    mtimes. A cache for the same shards and parameters with another state is
+    stale (a shard was rewritten) and is removed.
+    """
+    files = _file_identity(filenames)
+    shards = hashlib.sha1(json.dumps([f[0] for f in files]).encode()).hexdigest()[:8]
+    params = hashlib.sha1(json.dumps([CACHE_VERSION, labels, params], sort_keys = True, default = str).encode()).hexdigest()[:8]
+    state = hashlib.sha1(json.dumps(files).encode()).hexdigest()[:8]
+    name = f"{'+'.join(labels).replace(' ', '_')}-{shards}-{params}"
+    prefix = Path(cache_dir) / f"{name}-{state}"
+
+    Path(cache_dir).mkdir(parents = True, exist_ok = True)
+    for path in Path(cache_dir).glob(f"{name}-*"):
+        if not path.name.startswith(prefix.name):
+            path.unlink()
+    return prefix
+
+def _available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def decoded_size(filenames, fmt = 'float32', compression = 'NONE'):
+    """Size in bytes of the decoded signals in filenames, from the record
+    counts in the index or roughly from the file sizes."""
+    counts = indexed_counts(filenames)
+    if counts is not None:
+        return sum(counts) * N_SAMPLES * N_LEADS * 4
+    stored = sum(os.stat(f).st_size for f in filenames)
+    # float16 and int16 signals decode to float32; assume 2:1 compression
+    return stored * (1 if fmt == 'float32' else 2) * (1 if compression == 'NONE' else 2)
+
+def resolve_cache(cache, filenames, labels, params):
+    """What batch_dataset should cache to for a get_dataset cache argument:
+    None, True (memory) or an on-disk prefix."""
+    if cache is None or cache is False:
+        return None
+    if cache == 'auto':
+        size = decoded_size(filenames, params.get('fmt', 'float32'), params.get('compression', 'NONE'))
+        if size < CACHE_MEMORY_FRACTION * _available_memory():
+            return True
+        cache = DEFAULT_CACHE_DIR
+    if cache is True or cache == 'memory':
+        return True
+    return cache_file(cache, filenames, labels, params)
+
+def _cache_params(kwargs):
+    # options that only change file order, not the parsed examples
+    params = {k: v for k, v in kwargs.items() if k not in ('interleave', 'deterministic')}
+    if params.get('global_stats') is not None:
+        params['global_stats'] = [np.asarray(v).tolist() for v in params['global_stats']]
+    return params
+
+def augment_element(element, augment, training):
+    """Apply augment_batch to the ECG in a batched (x, ...) element, where x
+    is the ECG or a tuple (ecg, *inputs)."""
+    x, *rest = element
+    if isinstance(x, tuple):
+        x = (augment_batch(x[0], augment, training),) + x[1:]
+    else:
+        x = augment_batch(x, augment, training)
+    return (x, *rest)
+
+def batch_dataset(dataset, batch_size, shuffle = True, shuffle_buffer = DEFAULT_SHUFFLE_BUFFER, cache = None,
+        augment = None):
+    if cache is True:
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.cache(str(cache))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration = True)
+    dataset = dataset.batch(batch_size)
+    if augment is not None:
+        # random augmentation only for shuffled (training) datasets
+        dataset = dataset.map(lambda *element: augment_element(element, augment, shuffle),
+            num_parallel_calls = tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def get_dataset(filenames, label, batch_size = 64, shuffle = True, shuffle_buffer = DEFAULT_SHUFFLE_BUFFER,
+        cache = None, augment = None, **kwargs):
+    """Batched (x, y) dataset for training or evaluation on one label.
+
+    cache stores the parsed and filtered examples after the first epoch, so
+    later epochs skip reading and parsing; it is applied before the shuffle.
+    It is None (no cache), True or 'memory', a directory for an on-disk cache
+    (see cache_file), or 'auto' to use memory when the dataset fits and
+    DEFAULT_CACHE_DIR otherwise. augment is an ecg_augment.augment_config;
+    its random parts apply only when shuffle is True, so validation and test
+    sets get the center crop. Other keyword arguments are passed to
+    load_dataset.
+    """
+    dataset = load_dataset(filenames, label, shuffle_files = shuffle, **kwargs)
+    cache = resolve_cache(cache, filenames, [label], _cache_params(kwargs))
+    return batch_dataset(dataset, batch_size, shuffle, shuffle_buffer, cache, augment)
+
+def load_multitask_dataset(filenames, labels, ranges = None, fmt = 'float32', compression = 'NONE',
+        shuffle_files = False, interleave = 8, deterministic = False, normalize = 'zscore', global_stats = None):
+    """Unbatched (ecg, {label: y}, {label: weight}) examples for several labels.
+
+    Missing (NaN) or out-of-range labels get y = 0 and weight 0 so they do not
+    contribute to that head's loss; examples with no usable label are dropped.
+    ranges maps a label to (min_value, max_value), either of which may be None.
+    """
+    ranges = ranges or {}
+
+    def _parse(records):
+        ecg, values = parse_batch(records, labels, fmt, normalize, global_stats)
+        targets = {}
+        weights = {}
+        for label in labels:
+            y = tf.cast(values[label], tf.float32)
+            mask = label_mask({label: y}, [label], *ranges.get(label, (None, None)), label = label)
+            targets[label] = tf.where(mask, y, tf.zeros_like(y))
+            weights[label] = tf.cast(mask, tf.float32)
+        keep = tf.reduce_any(tf.stack([weights[label] > 0 for label in labels], axis = -1), axis = -1)
+        return (tf.boolean_mask(ecg, keep),
+            {k: tf.boolean_mask(v, keep) for k, v in targets.items()},
+            {k: tf.boolean_mask(v, keep) for k, v in weights.items()})
+
+    dataset = read_records(filenames, compression, shuffle_files, interleave, deterministic)
+    dataset = dataset.batch(PARSE_BATCH_SIZE)
+    dataset = dataset.map(_parse, num_parallel_calls = tf.data.AUTOTUNE, deterministic = deterministic)
+    return dataset.unbatch()
+
+def get_multitask_dataset(filenames, labels, batch_size = 64, shuffle = True, shuffle_buffer = DEFAULT_SHUFFLE_BUFFER,
+        cache = None, augment = None, **kwargs):
+    """Batched (ecg, targets, sample weights) dataset with one entry per label.
+    cache and augment are as for get_dataset."""
+    dataset = load_multitask_dataset(filenames, labels, shuffle_files = shuffle, **kwargs)
+    cache = resolve_cache(cache, filenames, list(labels), _cache_params(kwargs))
+    return batch_dataset(dataset, batch_size, shuffle, shuffle_buffer, cache, augment)
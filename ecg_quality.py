@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Per-record data-quality statistics, computed from a record that has already
+# been read (so preprocess_data.py gets them for free) and written as one
+# Parquet file per shard, by default in QUALITY_PATH. Each file keeps a hash
+# of the records (path and file_name) it describes in its Parquet metadata, so
+# summarize_data.py can tell when a file was written for other records (after
+# --head, --first, another --shard-size or a change to the split) and rescan.
+# show_data_quality.py aggregates the shard files.
+
+from pathlib import Path
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+QUALITY_PATH = "data/quality"
+RECORDS_KEY = b"ecg_quality_records"
+RECORD_COLUMNS = ['path', 'file_name']
+
+CANONICAL_SIG_ORDER = ['I', 'II', 'III', 'aVR', 'aVF', 'aVL', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+# a lead is flatlined if it holds one value for at least this long
+FLATLINE_SECONDS = 0.5
+
+def _longest_run(mask):
+    """Longest run of True in each column of a [n, leads] boolean array."""
+    out = np.zeros(mask.shape[1], dtype = np.int64)
+    for j in range(mask.shape[1]):
+        edges = np.diff(np.concatenate(([0], mask[:, j].astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        if len(starts):
+            out[j] = (np.flatnonzero(edges == -1) - starts).max()
+    return out
+
+def record_quality(r, dat):
+    """Quality statistics for a record read with physical=False.
+
+    r is the wfdb Record (for fs, lead names and the raw ADC samples) and dat
+    the physical signal with NaN for invalid samples.
+    """
+    d_signal = r.d_signal
+    with warnings.catch_warnings():
+        # all-NaN leads give NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        min_sig = np.nanmin(dat, axis=0)
+        max_sig = np.nanmax(dat, axis=0)
+        lead_mean = np.nanmean(dat, axis = 0)
+        lead_sd = np.nanstd(dat, axis = 0)
+
+    # equal consecutive samples; a run of k zero differences is k + 1 samples
+    flat_run = _longest_run(np.diff(d_signal, axis = 0) == 0) + 1
+    flatline = flat_run >= FLATLINE_SECONDS * r.fs
+
+    adc_res = np.array([res or 16 for res in (r.adc_res or [16] * r.n_sig)])
+    rail = 2 ** (adc_res - 1) - 1
+    # -2^(res-1) is the WFDB missing-sample marker, already NaN in dat
+    saturation = np.mean(((d_signal >= rail) | (d_signal <= -rail)) & ~np.isnan(dat), axis = 0)
+
+    ret_val = {
+        'fs': r.fs,
+        'n_samples': dat.shape[0],
+        'n_leads': dat.shape[1],
+        'mean': np.nanmean(dat),
+        'sd': np.nanstd(dat),
+        'all_zeros': bool(np.any(min_sig == max_sig)),
+        'any_nan': bool(np.any(np.isnan(dat))),
+        'flatline': bool(np.any(flatline)),
+        'saturated': bool(np.any(saturation > 0)),
+        # ecg_reader.EcgRecord has already reordered the leads
+        'lead_order_ok': list(getattr(r, 'source_sig_name', r.sig_name)) == CANONICAL_SIG_ORDER,
+    }
+
+    for j, lead in enumerate(r.sig_name):
+        ret_val[f"mean_{lead}"] = lead_mean[j]
+        ret_val[f"sd_{lead}"] = lead_sd[j]
+        ret_val[f"nan_{lead}"] = int(np.sum(np.isnan(dat[:, j])))
+        ret_val[f"flatline_{lead}"] = bool(flatline[j])
+        ret_val[f"saturation_{lead}"] = saturation[j]
+
+    return ret_val
+
+def unread_quality():
+    """record_quality's columns for a record that could not be read: NaN
+    statistics and every flag False, so a shard's columns keep their dtypes."""
+    ret_val = {'fs': np.nan, 'n_samples': np.nan, 'n_leads': np.nan, 'mean': np.nan, 'sd': np.nan,
+        'all_zeros': False, 'any_nan': False, 'flatline': False, 'saturated': False, 'lead_order_ok': False}
+    for lead in CANONICAL_SIG_ORDER:
+        ret_val[f"mean_{lead}"] = np.nan
+        ret_val[f"sd_{lead}"] = np.nan
+        ret_val[f"nan_{lead}"] = np.nan
+        ret_val[f"flatline_{lead}"] = False
+        ret_val[f"saturation_{lead}"] = np.nan
+    return ret_val
+
+def quality_file(path, dataset, shard):
+    return Path(path) / f"{dataset}-{shard:04}-quality.parquet"
+
+def records_hash(records):
+    """Hash of the path and file_name of a shard's input records (dicts), in
+    order."""
+    frame = pd.DataFrame(records, columns = RECORD_COLUMNS)
+    return hashlib.sha1(pd.util.hash_pandas_object(frame, index = False).values.tobytes()).hexdigest()
+
+def write_quality(path, dataset, shard, rows, records):
+    """Write the quality rows of shard, whose input records are records."""
+    Path(path).mkdir(parents = True, exist_ok = True)
+    table = pa.Table.from_pandas(pd.DataFrame(rows), preserve_index = False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[RECORDS_KEY] = records_hash(records).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), quality_file(path, dataset, shard))
+
+def quality_hash(path, dataset, shard):
+    """records_hash of the records a shard's quality file describes, or None
+    if there is no file or it predates the hash."""
+    path = quality_file(path, dataset, shard)
+    if not path.exists():
+        return None
+    value = (pq.read_schema(path).metadata or {}).get(RECORDS_KEY)
+    return value.decode() if value else None
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Fast reading of the MIMIC-IV-ECG WFDB records.
+#
+# EcgReader parses each record's .hea header once and keeps the metadata in
+# one Parquet index, memory-maps the format 16 .dat file instead of going
+# through wfdb.rdrecord, and reads many records at a time on a thread pool.
+# Every record comes back with its leads in CANONICAL_SIG_ORDER; records
+# missing a lead or not 500 Hz x 5000 samples raise RecordFormatError.
+# Records the memory-mapped path cannot read (other formats, multi-file or
+# multi-frequency records) are read with wfdb.rdrecord and checked the same way.
+#
+#   python ecg_reader.py --dataset train --threads 16
+#
+# builds or refreshes the header index for the train split; preprocess_data.py
+# and summarize_data.py do the same before reading. benchmark.py --stages
+# reader compares the reader with a plain rdrecord loop.
+
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import wfdb
+
+from ecg_quality import CANONICAL_SIG_ORDER
+from ecg_tables import read_table, read_split
+
+BASE_ECG_PATH = Path("/scratch/ajb5d/ecg/mimic-iv-ecg-diagnostic-electrocardiogram-matched-subset-1.0/")
+BASE_DATA_PATH = Path("./data/")
+DEFAULT_HEADER_INDEX = "data/wfdb-headers.parquet"
+
+SAMPLING_RATE = 500
+N_SAMPLES = 5000
+# format 16 marks a missing sample with the most negative value
+MISSING_16 = -32768
+
+class RecordFormatError(ValueError):
+    """A record without the 12 canonical leads at 500 Hz x 5000 samples."""
+
+class EcgRecord:
+    """A record's ADC samples and calibration in canonical lead order, with
+    the wfdb.Record attributes the quality checks and encoders use.
+    source_sig_name is the lead order in the file."""
+
+    def __init__(self, d_signal, missing, adc_gain, baseline, adc_res, fs, source_sig_name):
+        self.d_signal = d_signal
+        self.adc_gain = adc_gain
+        self.baseline = baseline
+        self.adc_res = adc_res
+        self.fs = fs
+        self.sig_name = list(CANONICAL_SIG_ORDER)
+        self.n_sig = len(self.sig_name)
+        self.source_sig_name = source_sig_name
+        self._missing = missing
+
+    def dac(self, return_res = 64):
+        """Physical signal in mV with NaN for missing samples, computed as
+        wfdb.Record.dac(return_res = 64) does."""
+        dat = self.d_signal.astype(np.float64)
+        np.subtract(dat, self.baseline, dat)
+        np.divide(dat, self.adc_gain, dat)
+        dat[self._missing] = np.nan
+        return dat
+
+def parse_header(record_path, hea_mtime_ns):
+    """Index row for one record's header."""
+    h = wfdb.rdheader(str(record_path))
+    n_sig = h.n_sig
+    mmap = (n_sig > 0 and len(set(h.file_name)) == 1 and all(f == '16' for f in h.fmt)
+        and all(s in (None, 1) for s in (h.samps_per_frame or [])) and not any(h.skew or []))
+    return {
+        'hea_mtime_ns': hea_mtime_ns,
+        'fs': float(h.fs),
+        'sig_len': int(h.sig_len or 0),
+        'n_sig': n_sig,
+        'mmap': mmap,
+        'dat_file': h.file_name[0] if n_sig else None,
+        'byte_offset': int((h.byte_offset or [0])[0] or 0) if n_sig else 0,
+        'sig_name': list(h.sig_name or []),
+        'adc_gain': [float(g) for g in (h.adc_gain or [])],
+        'baseline': [int(b) for b in (h.baseline or [])],
+        'adc_res': [int(r or 0) for r in (h.adc_res or [])],
+    }
+
+def lead_order(path, sig_name):
+    """Column of each canonical lead in a record with leads sig_name."""
+    names = list(sig_name)
+    missing = [lead for lead in CANONICAL_SIG_ORDER if lead not in names]
+    if missing:
+        raise RecordFormatError(f"{path}: missing leads {', '.join(missing)}")
+    return np.array([names.index(lead) for lead in CANONICAL_SIG_ORDER])
+
+class EcgReader:
+    """Reads records by path relative to base_path (absolute paths also work),
+    caching parsed headers in the Parquet file header_index if given."""
+
+    def __init__(self, base_path = BASE_ECG_PATH, header_index = None, threads = 8):
+        self.base_path = Path(base_path)
+        self.header_index = header_index
+        self.threads = threads
+        self._headers = {}
+        self._changed = False
+        if header_index is not None and Path(header_index).exists():
+            index = pd.read_parquet(header_index)
+            self._headers = dict(zip(index['path'], index.drop(columns = 'path').to_dict("records")))
+
+    def header(self, path):
+        """Header metadata for a record, re-parsed if its .hea file changed."""
+        path = str(path)
+        mtime = os.stat(self.base_path / f"{path}.hea").st_mtime_ns
+        h = self._headers.get(path)
+        if h is None or h['hea_mtime_ns'] != mtime:
+            h = parse_header(self.base_path / path, mtime)
+            self._headers[path] = h
+            self._changed = True
+        return h
+
+    def read(self, path):
+        """EcgRecord for one record, or RecordFormatError."""
+        h = self.header(path)
+        if h['fs'] != SAMPLING_RATE or h['sig_len'] != N_SAMPLES:
+            raise RecordFormatError(f"{path}: {h['fs']:g} Hz x {h['sig_len']} samples, "
+                f"expected {SAMPLING_RATE} Hz x {N_SAMPLES}")
+        order = lead_order(path, h['sig_name'])
+
+        if h['mmap']:
+            dat_path = (self.base_path / path).parent / h['dat_file']
+            shape = (h['sig_len'], h['n_sig'])
+            if os.path.getsize(dat_path) < h['byte_offset'] + 2 * shape[0] * shape[1]:
+                raise RecordFormatError(f"{path}: {h['dat_file']} is shorter than its header says")
+            samples = np.memmap(dat_path, dtype = '<i2', mode = 'r', offset = h['byte_offset'], shape = shape)
+            # rdrecord(physical = False) returns C-ordered 64 bit samples; the
+            # layout changes numpy's summation order and so the quality statistics
+            d_signal = np.ascontiguousarray(samples[:, order], dtype = np.int64)
+            del samples
+            missing = d_signal == MISSING_16
+        else:
+            r = wfdb.rdrecord(str(self.base_path / path), physical = False)
+            d_signal = np.ascontiguousarray(r.d_signal[:, order])
+            missing = np.isnan(r.dac(return_res = 64))[:, order]
+
+        fs = int(h['fs']) if float(h['fs']).is_integer() else h['fs']
+        return EcgRecord(d_signal, missing, np.asarray(h['adc_gain'])[order], np.asarray(h['baseline'])[order],
+            list(np.asarray(h['adc_res'])[order]), fs, list(h['sig_name']))
+
+    def _read_checked(self, path):
+        try:
+            return self.read(path), None
+        except RecordFormatError as e:
+            return None, e
+
+    def read_many(self, paths):
+        """(EcgRecord, None) or (None, RecordFormatError) for each path, in
+        order, read on the thread pool."""
+        if self.threads <= 1:
+            yield from map(self._read_checked, paths)
+            return
+        with ThreadPoolExecutor(self.threads) as pool:
+            yield from pool.map(self._read_checked, paths)
+
+    def update_index(self, paths):
+        """Parse the headers of paths not yet in the index (or changed since)
+        on the thread pool and save the index."""
+        with ThreadPoolExecutor(max(self.threads, 1)) as pool:
+            list(pool.map(self.header, paths))
+        self.save()
+
+    def save(self):
+        """Write the header index if any header was parsed since loading."""
+        if self.header_index is None or not self._changed:
+            return
+        index = pd.DataFrame.from_dict(self._headers, orient = "index")
+        index.index.name = 'path'
+        Path(self.header_index).parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = f"{self.header_index}.tmp"
+        index.reset_index().to_parquet(tmp_path, index = False)
+        os.replace(tmp_path, self.header_index)
+        self._changed = False
+
+def main():
+    parser = ArgumentParser(
+        prog = "ecg_reader.py",
+        description = "Build or refresh the WFDB header index"
+    )
+
+    parser.add_argument("--dataset", action = "store", choices = ['test', 'train', 'val'],
+        help = "index one split (default: every record in the ecgs table)")
+    parser.add_argument("--header-index", action = "store", default = DEFAULT_HEADER_INDEX)
+    parser.add_argument("--threads", action = "store", type = int, default = 8)
+    args = parser.parse_args()
+
+    if args.dataset:
+        paths = read_split(BASE_DATA_PATH, args.dataset, columns = ['path'])['path']
+    else:
+        paths = read_table(BASE_DATA_PATH, "ecgs", columns = ['path'])['path']
+
+    reader = EcgReader(BASE_ECG_PATH, args.header_index, args.threads)
+    reader.update_index(paths)
+    print(f"{len(paths)} records indexed in {args.header_index}")
+
+if __name__ == "__main__":
+    main()
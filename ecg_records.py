@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Encoding and decoding of the ECG signal stored in each TFRecord example.
+#
+# float32  'ecg/data' FloatList of 60000 values in millivolts
+# float16  'ecg/float16' bytes of 60000 float16 values in millivolts
+# int16    'ecg/int16' bytes of the raw 16-bit ADC samples plus per-lead
+#          'ecg/scale' and 'ecg/offset' such that data * scale + offset gives
+#          millivolts
+#
+# All formats use the same lead-major layout as 'ecg/data' (dat.T.flatten())
+# and decode to the same [5000, 12] tensor, so models do not care which format
+# a shard was written in.
+#
+# Every example also stores per-lead statistics of the raw signal
+# (STAT_FEATURES) and the normalization is applied when decoding, so trying
+# another normalization does not mean rebuilding the TFRecords:
+#
+# zscore   (x - mean) / std per record and lead (what models were trained on)
+# robust   (x - median) / iqr per record and lead
+# global   (x - mean) / std with one mean and std per lead for the dataset
+# none     raw millivolts
+
+from pathlib import Path
+import json
+import os
+import struct
+import numpy as np
+import tensorflow as tf
+
+N_SAMPLES = 5000
+N_LEADS = 12
+
+FORMATS = ['float32', 'float16', 'int16']
+COMPRESSION = ['NONE', 'GZIP', 'ZLIB']
+NORMALIZATIONS = ['zscore', 'robust', 'global', 'none']
+STAT_FEATURES = ['ecg/mean', 'ecg/std', 'ecg/median', 'ecg/iqr']
+
+def _tfr_bytes(v):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[v]))
+
+def _tfr_floats(v):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=v))
+
+def signal_feature_names(fmt):
+    return {
+        'float32': ['ecg/data'],
+        'float16': ['ecg/float16'],
+        'int16': ['ecg/int16', 'ecg/scale', 'ecg/offset'],
+    }[fmt] + STAT_FEATURES
+
+def signal_stats(p_signal):
+    """Per-lead statistics of [..., 5000, 12] physical signals."""
+    q25, median, q75 = np.percentile(p_signal, [25, 50, 75], axis = -2)
+    return {
+        'ecg/mean': np.mean(p_signal, axis = -2),
+        'ecg/std': np.std(p_signal, axis = -2),
+        'ecg/median': median,
+        'ecg/iqr': q75 - q25,
+    }
+
+def pooled_stats(means, stds):
+    """Dataset-wide per-lead (mean, std) from [N, 12] per-record means and
+    standard deviations of equal-length records."""
+    means = np.asarray(means, dtype = np.float64)
+    stds = np.asarray(stds, dtype = np.float64)
+    mean = means.mean(axis = 0)
+    std = np.sqrt((stds ** 2 + means ** 2).mean(axis = 0) - mean ** 2)
+    return mean.astype(np.float32), std.astype(np.float32)
+
+def encode_signal(fmt, p_signal, d_signal = None, adc_gain = None, baseline = None):
+    """Build the signal and statistics features for one [5000, 12] record.
+
+    p_signal is the physical signal; d_signal, adc_gain and baseline are the
+    raw ADC samples and their per-lead calibration, needed only for int16.
+    """
+    feature = {k: _tfr_floats(v) for k, v in signal_stats(p_signal).items()}
+
+    if fmt == 'float32':
+        feature['ecg/data'] = _tfr_floats(p_signal.T.flatten())
+    elif fmt == 'float16':
+        feature['ecg/float16'] = _tfr_bytes(p_signal.T.astype('<f2').tobytes())
+    elif fmt == 'int16':
+        # p = (d - baseline) / gain = d * scale + offset
+        adc_gain = np.asarray(adc_gain, dtype = np.float64)
+        baseline = np.asarray(baseline, dtype = np.float64)
+        feature['ecg/int16'] = _tfr_bytes(np.asarray(d_signal).T.astype('<i2').tobytes())
+        feature['ecg/scale'] = _tfr_floats(1.0 / adc_gain)
+        feature['ecg/offset'] = _tfr_floats(-baseline / adc_gain)
+    else:
+        raise ValueError(f"unknown ECG storage format: {fmt}")
+
+    return feature
+
+def stats_record_format():
+    return {k: tf.io.FixedLenFeature([N_LEADS], tf.float32) for k in STAT_FEATURES}
+
+def signal_record_format(fmt):
+    if fmt == 'float32':
+        spec = {'ecg/data': tf.io.FixedLenSequenceFeature([], tf.float32, allow_missing=True)}
+    elif fmt == 'float16':
+        spec = {'ecg/float16': tf.io.FixedLenFeature([], tf.string)}
+    elif fmt == 'int16':
+        spec = {
+            'ecg/int16': tf.io.FixedLenFeature([], tf.string),
+            'ecg/scale': tf.io.FixedLenFeature([N_LEADS], tf.float32),
+            'ecg/offset': tf.io.FixedLenFeature([N_LEADS], tf.float32),
+        }
+    else:
+        raise ValueError(f"unknown ECG storage format: {fmt}")
+    spec.update(stats_record_format())
+    return spec
+
+def normalize_signal(dat, stats, method = 'zscore', global_stats = None):
+    """Normalize lead-major [..., 60000] signals with per-lead statistics.
+
+    stats holds the parsed STAT_FEATURES ([..., 12] each); global_stats is the
+    per-lead (mean, std) pair used by the 'global' method.
+    """
+    if method == 'none':
+        return dat
+    if method == 'zscore':
+        center, spread = stats['ecg/mean'], stats['ecg/std']
+    elif method == 'robust':
+        center, spread = stats['ecg/median'], stats['ecg/iqr']
+    elif method == 'global':
+        if global_stats is None:
+            raise ValueError("global normalization needs global_stats")
+        center, spread = (tf.constant(v, dtype = tf.float32) for v in global_stats)
+    else:
+        raise ValueError(f"unknown normalization: {method}")
+
+    # samples are lead-major, so each lead's value covers N_SAMPLES values
+    center = tf.repeat(center, N_SAMPLES, axis = -1)
+    spread = tf.repeat(spread, N_SAMPLES, axis = -1)
+    return tf.math.divide_no_nan(dat - center, spread)
+
+def decode_signal(example, fmt, normalize = 'zscore', global_stats = None):
+    """Decode parsed signal features to [..., 5000, 12] float32, normalized
+    with normalize_signal ('none' gives millivolts).
+
+    Works on the output of both parse_single_example and parse_example.
+    """
+    if fmt == 'float32':
+        dat = example['ecg/data']
+    elif fmt == 'float16':
+        dat = tf.cast(tf.io.decode_raw(example['ecg/float16'], tf.float16, little_endian = True), tf.float32)
+    elif fmt == 'int16':
+        dat = tf.cast(tf.io.decode_raw(example['ecg/int16'], tf.int16, little_endian = True), tf.float32)
+        dat = (dat * tf.repeat(example['ecg/scale'], N_SAMPLES, axis = -1)
+            + tf.repeat(example['ecg/offset'], N_SAMPLES, axis = -1))
+    else:
+        raise ValueError(f"unknown ECG storage format: {fmt}")
+
+    dat = normalize_signal(dat, example, normalize, global_stats)
+    return tf.reshape(dat, tf.concat([tf.shape(dat)[:-1], [N_SAMPLES, N_LEADS]], axis = 0))
+
+def parse_ecg(record, fmt = 'float32', features = None, normalize = 'zscore', global_stats = None):
+    """Parse a single serialized example to (ecg [5000, 12], other features)."""
+    record_format = signal_record_format(fmt)
+    record_format.update(features or {})
+    example = tf.io.parse_single_example(record, record_format)
+    return decode_signal(example, fmt, normalize, global_stats), example
+
+def record_options(compression):
+    return tf.io.TFRecordOptions(compression_type = "" if compression == 'NONE' else compression)
+
+def index_file(path, dataset):
+    return Path(path) / f"{dataset}-index.json"
+
+def load_index(path, dataset):
+    """The index preprocess_data.py writes next to the shards: per-shard
+    'file', 'records', 'bytes' and, for uncompressed shards, 'offsets'."""
+    with open(index_file(path, dataset)) as fh:
+        return json.load(fh)
+
+def record_offsets(filename):
+    """Byte offset of every record in an uncompressed TFRecord file, from the
+    length headers alone (the records are skipped, not read)."""
+    offsets = []
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as fh:
+        position = 0
+        while position < size:
+            offsets.append(position)
+            length, = struct.unpack("<Q", fh.read(8))
+            # length, its CRC, the data and the data CRC
+            position += length + 16
+            fh.seek(position)
+    return offsets
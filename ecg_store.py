@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Memory-mapped ECG store: an alternative to TFRecords that supports random
+# access. A store for a dataset is two files in one directory:
+#
+#   {dataset}-ecg.npy      (N, 5000, 12) float32/float16 array of raw
+#                          millivolts, one row per input row of the
+#                          {dataset} split of the ecgs table
+#   {dataset}-ecg.parquet  one row per ECG with 'row', 'valid', 'file_name',
+#                          'study_id' and the same labels as the TFRecords
+#
+# Rows that failed the quality checks are zero filled and have valid == False.
+# Each row has the lead-major layout of the TFRecord 'ecg/data' feature, and
+# as_dataset normalizes batches with ecg_records.normalize_signal, so models
+# score identically on either source.
+
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+N_SAMPLES = 5000
+N_LEADS = 12
+
+STORE_DTYPES = {'float32': np.float32, 'float16': np.float16}
+
+def signal_file(path, dataset):
+    return Path(path) / f"{dataset}-ecg.npy"
+
+def label_file(path, dataset):
+    return Path(path) / f"{dataset}-ecg.parquet"
+
+def create_store(path, dataset, n_rows, fmt = 'float32'):
+    if fmt not in STORE_DTYPES:
+        raise ValueError(f"memmap store does not support format {fmt}")
+    signals = np.lib.format.open_memmap(signal_file(path, dataset), mode = "w+",
+        dtype = STORE_DTYPES[fmt], shape = (n_rows, N_SAMPLES, N_LEADS))
+    del signals
+
+def write_rows(path, dataset, start, signals):
+    store = np.load(signal_file(path, dataset), mmap_mode = "r+")
+    store[start:start + len(signals)] = signals
+    store.flush()
+
+def write_labels(path, dataset, labels):
+    labels.to_parquet(label_file(path, dataset), index = False)
+
+class EcgStore:
+    def __init__(self, path, dataset):
+        self.signals = np.load(signal_file(path, dataset), mmap_mode = "r")
+        self.labels = pd.read_parquet(label_file(path, dataset))
+        self._rows = pd.Series(self.labels['row'].values, index = self.labels['file_name'].values)
+
+    def __len__(self):
+        return len(self.signals)
+
+    def __getitem__(self, rows):
+        return self.signals[rows]
+
+    def row(self, file_name):
+        return self._rows[file_name]
+
+    def lookup(self, file_name):
+        return self.signals[self._rows[file_name]]
+
+    def select(self, label = None, query = None):
+        """Row numbers of valid ECGs with a non-NaN label and matching query."""
+        labels = self.labels[self.labels['valid']]
+        if label is not None:
+            labels = labels[labels[label].notna()]
+        if query is not None:
+            labels = labels.query(query)
+        return labels['row'].values
+
+    def stats(self, rows):
+        """Per-lead STAT_FEATURES of the given rows, [len(rows), 12] each."""
+        from ecg_records import signal_stats
+
+        signals = self.signals[rows].astype(np.float32)
+        # lead-major rows: lead j is samples [j * 5000, (j + 1) * 5000)
+        leads = signals.reshape(len(signals), N_LEADS, N_SAMPLES)
+        return {k: v.astype(np.float32) for k, v in signal_stats(leads.swapaxes(1, 2)).items()}
+
+    def global_stats(self, rows = None, chunk_size = 1024):
+        """Per-lead (mean, std) over rows (default: all valid rows), for
+        normalize = 'global'."""
+        from ecg_records import pooled_stats
+
+        if rows is None:
+            rows = self.select()
+        rows = np.sort(rows)
+        means, stds = [], []
+        for start in range(0, len(rows), chunk_size):
+            stats = self.stats(rows[start:start + chunk_size])
+            means.append(stats['ecg/mean'])
+            stds.append(stats['ecg/std'])
+        return pooled_stats(np.concatenate(means), np.concatenate(stds))
+
+    def as_dataset(self, label, rows = None, batch_size = 64, shuffle = False, seed = None,
+            normalize = 'zscore', global_stats = None, augment = None):
+        """tf.data pipeline of (ecg, label) batches gathered from the memmap.
+
+        Shuffling permutes row indices only, so every epoch is a full random
+        shuffle without a shuffle buffer. Batches are normalized as in
+        ecg_records.decode_signal, and augmented as in ecg_pipeline.get_dataset
+        (randomly only when shuffling).
+        """
+        import tensorflow as tf
+        from ecg_records import STAT_FEATURES, normalize_signal
+        from ecg_augment import augment_batch
+
+        if rows is None:
+            rows = self.select(label)
+        values = self.labels.set_index('row')[label].astype(np.float32)
+
+        def _gather(idx):
+            # read the memmap in row order, then put the batch back in idx's order
+            order = np.argsort(idx)
+            restore = np.argsort(order)
+            stats = self.stats(idx[order])
+            return (self.signals[idx[order]].astype(np.float32)[restore], values.loc[idx].values,
+                *[stats[k][restore] for k in STAT_FEATURES])
+
+        def _normalize(x, y, *stats):
+            flat = tf.reshape(x, [-1, N_SAMPLES * N_LEADS])
+            stats = {k: tf.ensure_shape(v, [None, N_LEADS]) for k, v in zip(STAT_FEATURES, stats)}
+            flat = normalize_signal(flat, stats, normalize, global_stats)
+            x = tf.reshape(flat, [-1, N_SAMPLES, N_LEADS])
+            if augment is not None:
+                x = augment_batch(x, augment, shuffle)
+            return x, tf.ensure_shape(y, [None])
+
+        dataset = tf.data.Dataset.from_tensor_slices(np.asarray(rows, dtype = np.int64))
+        if shuffle:
+            dataset = dataset.shuffle(len(rows), seed = seed, reshuffle_each_iteration = True)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(
+            lambda idx: tf.numpy_function(_gather, [idx], [tf.float32] * (2 + len(STAT_FEATURES))),
+            num_parallel_calls = tf.data.AUTOTUNE)
+        dataset = dataset.map(_normalize, num_parallel_calls = tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
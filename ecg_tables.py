@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Reading and writing the cohort and label tables passed between
+# create_test_train_split.py, create_outcomes.py and preprocess_data.py.
+# The cohort is one ecgs table with a 'split' column; read_split selects one
+# split from it.
+# Tables are written as Parquet; a table can be read from either Parquet or
+# CSV under the same name, and Parquet is preferred when both exist.
+# iter_table and write_table_chunks stream a table in bounded-memory chunks;
+# chunk_rows sizes the chunks for a memory ceiling.
+
+from pathlib import Path
+import pandas as pd
+
+def table_path(base_path, name):
+    for suffix in [".parquet", ".csv"]:
+        path = Path(base_path) / f"{name}{suffix}"
+        if path.exists():
+            return path
+    raise FileNotFoundError(f"no {name}.parquet or {name}.csv in {base_path}")
+
+def read_table(base_path, name, columns = None, dates = (), dtype = None):
+    """Read only `columns` of a table, parsing `dates` to datetimes if the
+    file does not already store them typed."""
+    path = table_path(base_path, name)
+    if path.suffix == ".parquet":
+        df = pd.read_parquet(path, columns = columns)
+        if dtype:
+            df = df.astype(dtype)
+    else:
+        df = pd.read_csv(path, usecols = columns, dtype = dtype)
+
+    return _parse_dates(df, dates)
+
+def _parse_dates(df, dates):
+    for col in dates:
+        if not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+def iter_table(base_path, name, columns = None, dates = (), dtype = None, chunk_rows = 100000):
+    """read_table in chunks of at most chunk_rows rows, in table order."""
+    path = table_path(base_path, name)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunk_rows, columns = columns):
+            df = batch.to_pandas()
+            if dtype:
+                df = df.astype(dtype)
+            yield _parse_dates(df, dates)
+    else:
+        with pd.read_csv(path, usecols = columns, dtype = dtype, chunksize = chunk_rows) as reader:
+            for df in reader:
+                yield _parse_dates(df, dates)
+
+# working copies made while a chunk is parsed, sorted and merged
+CHUNK_OVERHEAD = 4
+
+def chunk_rows(memory_mb, base_path, name, columns = None, dates = (), dtype = None, sample_rows = 1000):
+    """Rows per chunk so that processing one chunk of a table stays within
+    about memory_mb, estimated from the in-memory size of its first rows."""
+    sample = next(iter_table(base_path, name, columns, dates, dtype, chunk_rows = sample_rows))
+    row_bytes = sample.memory_usage(deep = True).sum() / max(len(sample), 1)
+    return max(int(memory_mb * 2 ** 20 / (row_bytes * CHUNK_OVERHEAD)), 1)
+
+def read_split(base_path, dataset, columns = None):
+    """Rows of the ecgs table in one split, in table order, falling back to
+    a per-split {dataset}_ecgs table from older runs."""
+    try:
+        path = table_path(base_path, "ecgs")
+    except FileNotFoundError:
+        return read_table(base_path, f"{dataset}_ecgs", columns = columns)
+
+    if path.suffix == ".parquet":
+        df = pd.read_parquet(path, columns = columns, filters = [("split", "==", dataset)])
+    else:
+        df = pd.read_csv(path, usecols = None if columns is None else columns + ['split'])
+        df = df[df['split'] == dataset]
+        if columns is not None:
+            df = df[columns]
+    return df.reset_index(drop = True)
+
+def write_table(df, base_path, name):
+    """Write a table as typed Parquet, so readers get datetimes and
+    categoricals back without re-parsing."""
+    path = Path(base_path) / f"{name}.parquet"
+    df.to_parquet(path, index = False)
+    return path
+
+def write_table_chunks(chunks, base_path, name):
+    """write_table for an iterable of DataFrames with the same columns and
+    dtypes, holding one chunk in memory at a time."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = Path(base_path) / f"{name}.parquet"
+    writer = None
+    try:
+        for df in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index = False)
+                writer = pq.ParquetWriter(path, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema = writer.schema, preserve_index = False)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Inference-only runtime for models exported by export_model.py. Uses the
+# standalone tflite_runtime package when it is installed and falls back to
+# tf.lite otherwise. This module alone then needs no TensorFlow, but
+# score_ecgs.py --runtime tflite still imports it: the shards are read and
+# decoded with tf.data, and only the model runs on the TFLite interpreter.
+
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+class TFLiteModel:
+    """A single-output .tflite model callable like a Keras model on a
+    float32 batch of its input shape ([B, 5000, 12] unless exported from a
+    model trained on crops); returns a [B, 1] array."""
+
+    def __init__(self, path, threads = None):
+        self.interpreter = Interpreter(model_path = str(path), num_threads = threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self._shape = None
+
+    def __call__(self, x, training = False):
+        x = np.asarray(x, dtype = np.float32)
+        if self._shape != x.shape:
+            self.interpreter.resize_tensor_input(self.input['index'], x.shape)
+            self.interpreter.allocate_tensors()
+            self._shape = x.shape
+        self.interpreter.set_tensor(self.input['index'], x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index'])
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Training-loop helpers shared by the training scripts.
+#
+# To see whether training is bound by the input pipeline or by compute, add
+# the profiling callback:
+#
+#   profiler = profile_training(train_dataset, output_path, parse_seconds = parse_time(TRAIN_RECS))
+#   model.fit(train_dataset, ..., callbacks = [..., profiler])
+#
+# which writes {output_path}/profile/steps.csv (per step), epochs.json (per
+# epoch), input.csv and input.json (the input probe) and, with trace_steps, a
+# TensorFlow profiler trace for TensorBoard. The dataset is trained on as is;
+# before the first epoch the probe trains a copy of the model on its own
+# iterator over the dataset, timing each next() (input wait) and each step.
+
+import csv
+import json
+import os
+import resource
+import tensorflow as tf
+import time
+from pathlib import Path
+
+# mode: (Keras dtype policy, jit_compile)
+#
+# Under a mixed policy Keras computes in float16/bfloat16 with float32
+# variables, and compile() wraps the optimizer in a LossScaleOptimizer for
+# float16. Output layers should be built with dtype='float32' so regression
+# targets are predicted and scored at full precision.
+TRAINING_MODES = {
+    'float32': ('float32', False),
+    'xla': ('float32', True),
+    'mixed_float16': ('mixed_float16', True),
+    'mixed_bfloat16': ('mixed_bfloat16', True),
+}
+
+def set_training_mode(mode):
+    """Set the global precision policy for mode; returns jit_compile for model.compile."""
+    policy, jit_compile = TRAINING_MODES[mode]
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return jit_compile
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """Adds epoch_time and step_time (mean seconds per training step) to the
+    epoch logs, so CSVLogger records them. Put it before CSVLogger."""
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+        self._last_step = self._start
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._last_step = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        step_time = (self._last_step - self._start) / max(self._steps, 1)
+        epoch_time = time.perf_counter() - self._start
+        if logs is not None:
+            logs['epoch_time'] = epoch_time
+            logs['step_time'] = step_time
+        print(f"Epoch {epoch + 1}: {epoch_time:0.1f}s, {step_time * 1000:0.1f} ms/step")
+
+def host_memory_mb():
+    """Resident memory of this process in MB (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# probe steps before timing starts (tracing, compilation, shuffle buffer fill)
+PROBE_WARMUP = 3
+PROBE_STEPS = 20
+
+def probe_model(model):
+    """A copy of a compiled model, with its weights, a fresh optimizer of the
+    same configuration and the same loss, to time training steps on without
+    touching the model or its optimizer state."""
+    clone = tf.keras.models.clone_model(model)
+    clone.set_weights(model.get_weights())
+    # a mixed float16 model's optimizer is wrapped for loss scaling; compile wraps it again
+    optimizer = getattr(model.optimizer, 'inner_optimizer', model.optimizer)
+    clone.compile(optimizer = optimizer.__class__.from_config(optimizer.get_config()), loss = model.loss,
+        jit_compile = getattr(model, 'jit_compile', False))
+    return clone
+
+def input_probe(model, dataset, steps = PROBE_STEPS, warmup = PROBE_WARMUP):
+    """[(input_wait, compute_time)] in seconds for up to `steps` training
+    steps of probe_model(model) on dataset, after `warmup` steps. input_wait
+    is the time next() blocks on the dataset's iterator, so the pipeline keeps
+    prefetching while a step runs, as it does under fit."""
+    clone = probe_model(model)
+    iterator = iter(dataset)
+    times = []
+    for step in range(warmup + steps):
+        start = time.perf_counter()
+        try:
+            x, y, *weights = next(iterator)
+        except StopIteration:
+            break
+        fetched = time.perf_counter()
+        clone.train_on_batch(x, y, sample_weight = weights[0] if weights else None)
+        if step >= warmup:
+            times.append((fetched - start, time.perf_counter() - fetched))
+    del iterator
+    return times
+
+STEP_FIELDS = ['epoch', 'step', 'warmup', 'step_time', 'examples', 'examples_per_sec', 'parse_time',
+    'host_memory_mb']
+
+class StepProfiler(tf.keras.callbacks.Callback):
+    """Records for each training step its time, examples/sec, estimated
+    parse time and host memory to {output_path}/profile, and before training
+    how long the input pipeline keeps a step waiting (input_probe).
+
+    The probe's per-step input wait and compute time go to input.csv and its
+    means and input fraction to input.json. The first warmup_steps training
+    steps (tracing and compilation) are marked in steps.csv and left out of
+    the epoch totals. parse_seconds is the per-example parse cost from
+    ecg_pipeline.parse_time; parsing runs on tf.data threads, so parse_time
+    per step is that cost times the step's examples. trace_steps = (start,
+    stop) captures a profiler trace of training steps [start, stop) counted
+    across epochs."""
+
+    def __init__(self, dataset, output_path, parse_seconds = None, trace_steps = None,
+            probe_steps = PROBE_STEPS, warmup_steps = PROBE_WARMUP):
+        super().__init__()
+        self.dataset = dataset
+        self.probe_steps = probe_steps
+        self.warmup_steps = warmup_steps
+        self.parse_seconds = parse_seconds
+        self.trace_steps = trace_steps
+        self.profile_path = Path(output_path) / "profile"
+        self._global_step = 0
+        self._tracing = False
+        self._batch = None
+
+    def on_train_begin(self, logs=None):
+        self.profile_path.mkdir(parents = True, exist_ok = True)
+        self._steps_file = open(self.profile_path / "steps.csv", "w", newline = "")
+        self._steps = csv.DictWriter(self._steps_file, STEP_FIELDS)
+        self._steps.writeheader()
+        self._epochs = []
+        self._probe()
+
+    def _probe(self):
+        times = input_probe(self.model, self.dataset, self.probe_steps, self.warmup_steps)
+        with open(self.profile_path / "input.csv", "w", newline = "") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['step', 'input_wait', 'compute_time'])
+            writer.writerows((i, wait, compute) for i, (wait, compute) in enumerate(times))
+
+        wait = sum(w for w, _ in times) / max(len(times), 1)
+        compute = sum(c for _, c in times) / max(len(times), 1)
+        input_fraction = wait / (wait + compute) if wait + compute else 0.0
+        with open(self.profile_path / "input.json", "w") as fh:
+            json.dump({'steps': len(times), 'warmup_steps': self.warmup_steps, 'input_wait': wait,
+                'compute_time': compute, 'input_fraction': input_fraction}, fh, indent = 2)
+        bound = "input" if input_fraction > 0.5 else "compute"
+        print(f"Input probe: {input_fraction:0.0%} of step time waiting on input ({bound} bound), "
+            f"{wait * 1000:0.1f} ms wait + {compute * 1000:0.1f} ms compute per step over {len(times)} steps")
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._epoch_start = time.perf_counter()
+        self._totals = {'steps': 0, 'step_time': 0.0, 'examples': 0}
+        self._peak_memory = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace_steps and self._global_step == self.trace_steps[0]:
+            tf.profiler.experimental.start(str(self.profile_path / "trace"))
+            self._tracing = True
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_time = time.perf_counter() - self._step_start
+        examples = self._batch_size()
+        memory = host_memory_mb()
+        self._peak_memory = max(self._peak_memory, memory)
+        warmup = self._global_step < self.warmup_steps
+
+        self._steps.writerow({
+            'epoch': self._epoch, 'step': batch, 'warmup': int(warmup), 'step_time': step_time,
+            'examples': examples, 'examples_per_sec': examples / step_time if step_time else 0.0,
+            'parse_time': self.parse_seconds * examples if self.parse_seconds is not None else '',
+            'host_memory_mb': memory,
+        })
+        if not warmup:
+            for key, value in [('steps', 1), ('step_time', step_time), ('examples', examples)]:
+                self._totals[key] += value
+
+        self._global_step += 1
+        if self._tracing and self._global_step >= self.trace_steps[1]:
+            self._stop_trace()
+
+    def _batch_size(self):
+        # fit does not report batch sizes; the last batch of an epoch may be short
+        if self._batch is None:
+            self._batch = tf.nest.flatten(self.dataset.element_spec)[0].shape[0]
+            if self._batch is None:
+                self._batch = int(tf.shape(tf.nest.flatten(next(iter(self.dataset.take(1))))[0])[0])
+        return self._batch
+
+    def on_epoch_end(self, epoch, logs=None):
+        t = self._totals
+        summary = {
+            'epoch': epoch,
+            'steps': t['steps'],
+            'train_time': t['step_time'],
+            'examples': t['examples'],
+            'examples_per_sec': t['examples'] / t['step_time'] if t['step_time'] else 0.0,
+            'parse_time': self.parse_seconds * t['examples'] if self.parse_seconds is not None else None,
+            'epoch_time': time.perf_counter() - self._epoch_start,
+            'peak_host_memory_mb': self._peak_memory,
+        }
+        self._epochs.append(summary)
+        self._steps_file.flush()
+        with open(self.profile_path / "epochs.json", "w") as fh:
+            json.dump(self._epochs, fh, indent = 2)
+        print(f"Epoch {epoch + 1}: {summary['examples_per_sec']:0.1f} examples/sec after warm-up")
+
+    def on_train_end(self, logs=None):
+        if self._tracing:
+            self._stop_trace()
+        self._steps_file.close()
+
+    def _stop_trace(self):
+        tf.profiler.experimental.stop()
+        self._tracing = False
+
+def profile_training(dataset, output_path, parse_seconds = None, trace_steps = None):
+    """StepProfiler callback for profiling training on dataset in a run whose
+    checkpoints go to output_path (from ecg_models.make_checkpoint_dir)."""
+    return StepProfiler(dataset, output_path, parse_seconds, trace_steps)
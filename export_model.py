@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Export a trained model to an inference-only TFLite file, optionally with
+# post-training quantization, and report accuracy against speed on the test
+# split.
+#
+#   python export_model.py --model resnet-age --label age --quantize none float16 int8
+#
+# writes {output}/{model}.tflite, {model}-float16.tflite and {model}-int8.tflite
+# plus {output}/{model}-report.json comparing every variant with the Keras
+# model. int8 uses full-integer weights and activations calibrated on training
+# ECGs, with float32 input and output so callers do not change.
+# score_ecgs.py --runtime tflite scores with the exported files. A model
+# trained on crops or resampled signals (with an ecg_augment config next to
+# it) is exported at its cropped input shape, its config is copied next to
+# each .tflite file, and it is calibrated on center crops and evaluated on the
+# mean over --crops crops, as score_ecgs.py scores it.
+
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from ecg_pipeline import load_dataset, dataset_stats
+from ecg_records import FORMATS, COMPRESSION, NORMALIZATIONS, N_SAMPLES, N_LEADS
+from ecg_tflite import TFLiteModel
+from score_ecgs import model_file, load_augment, predict as predict_batch
+from ecg_augment import input_shape, multi_crop, augment_file, save_config
+
+QUANTIZATIONS = ['none', 'float16', 'int8']
+BINARY_LABELS = ['gender', 'hospital_expire_flag', 'icu_expire_flag']
+
+def tflite_file(output_path, model_name, quantize):
+    suffix = "" if quantize == 'none' else f"-{quantize}"
+    return Path(output_path) / f"{model_name}{suffix}.tflite"
+
+def load_examples(filenames, label, n, dataset_args):
+    dataset = load_dataset(filenames, label, deterministic = True, **dataset_args).take(n).batch(n)
+    x, y = next(iter(dataset))
+    return x.numpy(), y.numpy().astype(np.float64)
+
+def convert(model, quantize, calibration = None):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([calibration[i:i + 1]] for i in range(len(calibration)))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+def score(label, y, pred):
+    if label in BINARY_LABELS:
+        auc = tf.keras.metrics.AUC()
+        auc.update_state(y, pred)
+        return {'auc': float(auc.result()), 'accuracy': float(np.mean((pred > 0.5) == (y > 0.5)))}
+    return {'mae': float(np.mean(np.abs(pred - y))), 'rmse': float(np.sqrt(np.mean((pred - y) ** 2)))}
+
+def center_crops(x, augment):
+    """x cropped and resampled to the model input, or x itself without augment."""
+    return x if augment is None else multi_crop(x, augment, 1)[0].numpy()
+
+def predict(model, x, batch_size, augment = None, crops = 1):
+    return np.concatenate([predict_batch(model, x[i:i + batch_size], augment, crops)
+        for i in range(0, len(x), batch_size)])
+
+def latency(model, x, batch_size, repeats):
+    """Median milliseconds per call on one batch, after a warm-up call."""
+    batch = x[:batch_size]
+    model(batch, training = False)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(batch, training = False)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+def evaluate(name, model, label, x, y, reference, batch_size, repeats, size_bytes, augment = None, crops = 1):
+    pred = predict(model, x, batch_size, augment, crops)
+    # latency is per model call, on one (center) crop per ECG
+    x_model = center_crops(x[:batch_size], augment)
+    result = {
+        'variant': name,
+        'size_mb': size_bytes / 2 ** 20,
+        **score(label, y, pred),
+        'max_abs_diff': float(np.max(np.abs(pred - reference))) if reference is not None else 0.0,
+        'latency_ms_batch1': latency(model, x_model, 1, repeats),
+        f'latency_ms_batch{batch_size}': latency(model, x_model, batch_size, repeats),
+    }
+    result['ecgs_per_sec'] = batch_size / result[f'latency_ms_batch{batch_size}'] * 1000
+    return result, pred
+
+def main():
+    parser = ArgumentParser(
+        prog = "export_model.py",
+        description = "Export a model to TFLite with optional quantization and compare accuracy and speed"
+    )
+
+    parser.add_argument("--model", action = "store", required = True,
+        help = "model name in --model-dir, or a path to a .keras file or SavedModel directory")
+    parser.add_argument("--model-dir", action = "store", default = "data/models")
+    parser.add_argument("--label", action = "store", required = True, help = "label the model predicts, for the report")
+    parser.add_argument("--quantize", action = "store", nargs = "+", choices = QUANTIZATIONS, default = QUANTIZATIONS)
+    parser.add_argument("--output", action = "store", default = "data/exported")
+    parser.add_argument("--data", action = "store", default = "/scratch/ajb5d/ecg/tfrecords/")
+    parser.add_argument("--test-pattern", action = "store", default = "test*.tfrecords")
+    parser.add_argument("--calibration-pattern", action = "store", default = "train*.tfrecords")
+    parser.add_argument("--calibration-examples", action = "store", type = int, default = 200)
+    parser.add_argument("--eval-examples", action = "store", type = int, default = 2000)
+    parser.add_argument("--batch-size", action = "store", type = int, default = 64)
+    parser.add_argument("--repeats", action = "store", type = int, default = 10)
+    parser.add_argument("--format", action = "store", choices = FORMATS, default = 'float32')
+    parser.add_argument("--compression", action = "store", choices = COMPRESSION, default = 'NONE')
+    parser.add_argument("--normalize", action = "store", choices = NORMALIZATIONS, default = 'zscore')
+    parser.add_argument("--crops", action = "store", type = int, default = 1,
+        help = "for models trained on crops, evaluate on the mean over this many evenly spaced crops per ECG")
+    args = parser.parse_args()
+
+    model_path = Path(args.model)
+    if not model_path.exists():
+        model_path = model_file(args.model_dir, args.model)
+    model_name = model_path.stem if model_path.suffix == ".keras" else model_path.name
+    model = tf.keras.models.load_model(str(model_path))
+    augment = load_augment(model_path.parent, model_name)
+    expected = input_shape(augment) if augment else (N_SAMPLES, N_LEADS)
+    if model.input_shape[1:] != tuple(expected) or len(model.outputs) != 1:
+        raise ValueError(f"export supports single-input, single-output ECG models with {expected} input")
+
+    data_path = Path(args.data)
+    dataset_args = dict(fmt = args.format, compression = args.compression, normalize = args.normalize)
+    calibration_recs = sorted(data_path.glob(args.calibration_pattern))
+    if args.normalize == 'global':
+        dataset_args['global_stats'] = dataset_stats(calibration_recs, args.compression)
+    x, y = load_examples(sorted(data_path.glob(args.test_pattern)), args.label, args.eval_examples, dataset_args)
+    calibration = None
+    if 'int8' in args.quantize:
+        calibration, _ = load_examples(calibration_recs, args.label, args.calibration_examples, dataset_args)
+        calibration = center_crops(calibration, augment)
+
+    Path(args.output).mkdir(parents = True, exist_ok = True)
+    results = []
+    keras_result, reference = evaluate('keras', model, args.label, x, y, None, args.batch_size, args.repeats,
+        sum(w.numpy().nbytes for w in model.weights), augment, args.crops)
+    results.append(keras_result)
+
+    for quantize in args.quantize:
+        path = tflite_file(args.output, model_name, quantize)
+        path.write_bytes(convert(model, quantize, calibration))
+        if augment:
+            save_config(augment_file(args.output, path.stem), augment)
+        result, _ = evaluate(f"tflite-{quantize}", TFLiteModel(path), args.label, x, y, reference,
+            args.batch_size, args.repeats, path.stat().st_size, augment, args.crops)
+        result['file'] = str(path)
+        results.append(result)
+
+    report = {'model': str(model_path), 'label': args.label, 'examples': len(x), 'results': results}
+    report_path = Path(args.output) / f"{model_name}-report.json"
+    with open(report_path, "w") as fh:
+        json.dump(report, fh, indent = 2)
+
+    metric = 'auc' if args.label in BINARY_LABELS else 'mae'
+    print(f"{'variant':<16}{'MB':>8}{metric:>10}{'max diff':>10}{'ms/ECG':>10}{'ECG/s':>10}")
+    for r in results:
+        print(f"{r['variant']:<16}{r['size_mb']:>8.2f}{r[metric]:>10.4f}{r['max_abs_diff']:>10.4f}"
+            f"{r['latency_ms_batch1']:>10.2f}{r['ecgs_per_sec']:>10.1f}")
+    print(f"Report: {report_path}")
+
+if __name__ == "__main__":
+    main()
@@ -7,22 +7,35 @@ import tensorflow as tf
 import numpy as np
 from tqdm import tqdm
 from argparse import ArgumentParser
+from multiprocessing import get_context
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
 
-parser = ArgumentParser(
-    prog = "summarize_data.py",
-    description = "Summarize and report data quality"
-)
-
-parser.add_argument("--dataset", action = "store", required = True, choices = ['test', 'train', 'val'])
-parser.add_argument("--output", action = "store", required = True)
-parser.add_argument("--first", action = "store", type=int)
-args = parser.parse_args()
+from ecg_records import FORMATS, COMPRESSION, signal_feature_names, encode_signal, record_options, index_file, load_index, record_offsets
+import ecg_store
+from ecg_quality import QUALITY_PATH, record_quality, unread_quality, write_quality
+from ecg_tables import read_table, read_split
+from ecg_reader import EcgReader, DEFAULT_HEADER_INDEX
 
 BASE_ECG_PATH = Path("/scratch/ajb5d/ecg/mimic-iv-ecg-diagnostic-electrocardiogram-matched-subset-1.0/")
 BASE_DATA_PATH = Path("./data/")
-OUTPUT_DATA_PATH = Path(args.output)
 
+# Shards are cut on input rows (not on written records) so that shard k always
+# holds rows [k * shard_size, (k + 1) * shard_size) of the {dataset} split no
+# matter how many workers are used. shard_size is SHARD_SIZE, --shard-size, or
+# derived from --shard-bytes by sizing a sample of serialized records; shards
+# hold fewer records than rows when records fail the quality checks.
 SHARD_SIZE = 512
+SHARD_SAMPLE = 16
+
+# The manifest is rewritten at most this often while shards are written (and
+# once at the end); shards finished since the last save are rebuilt if the run
+# is interrupted. Record offsets are kept only in the index.
+MANIFEST_SECONDS = 60
 
 def _tfr_int(v):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[v]))
@@ -30,78 +43,442 @@ def _tfr_int(v):
 def _tfr_float(v):
     return tf.train.Feature(float_list=tf.train.FloatList(value=[v]))
 
-def wfdb_to_example(rec, labs, hosp):
-    r = wfdb.rdrecord(BASE_ECG_PATH / rec.path)
-    dat = r.p_signal
-    min = np.min(dat, axis=0)
-    max = np.max(dat, axis=0)
+LAB_LABELS = ["troponin i", "potassium", "sodium"]
+LAB_COLUMNS = [c for label in LAB_LABELS for c in (label, f"{label}_offset")]
+HOSP_COLUMNS = ['hospital_expire_flag', 'icu_expire_flag', 'ecg_offset']
 
-    if np.any(min == max) or np.any(np.isnan(dat)):
-        return None
+# Bump SIGNAL_VERSION whenever the way the signal features are computed
+# changes so the manifest forces a full rebuild instead of a relabel.
+SIGNAL_VERSION = 2
+SIGNAL_COLUMNS = ['path', 'file_name']
+ECG_COLUMNS = ['subject_id', 'study_id', 'file_name', 'path', 'ecg_age', 'gender']
+LABEL_COLUMNS = ['ecg_age', 'gender'] + LAB_COLUMNS + HOSP_COLUMNS
+
+def example_features(fmt):
+    return signal_feature_names(fmt) + ['age', 'gender', 'file_name'] + LAB_COLUMNS + HOSP_COLUMNS
+
+def attach_labels(ecg_data, labs, hosp):
+    # one vectorized left join per table instead of a boolean scan per record;
+    # studies without a match get NaN, and the first match wins on duplicates
+    labs = labs.drop_duplicates("study_id")[["study_id"] + LAB_COLUMNS]
+    hosp = hosp.drop_duplicates("study_id")[["study_id"] + HOSP_COLUMNS]
+    return (ecg_data
+        .merge(labs, on = "study_id", how = "left")
+        .merge(hosp, on = "study_id", how = "left"))
 
-    dat = (dat - np.mean(dat, axis = 0)) / np.std(dat, axis = 0)
-    gender_value = 1 if rec.gender == "M" else 0
+def label_features(rec):
+    gender_value = 1 if rec["gender"] == "M" else 0
 
     feature = {
-        'ecg/data': tf.train.Feature(float_list=tf.train.FloatList(value=dat.T.flatten())),
-        'age': _tfr_float(rec.ecg_age),
+        'age': _tfr_float(rec["ecg_age"]),
         'gender': _tfr_int(gender_value),
-        'file_name': _tfr_int(rec.file_name),
+        'file_name': _tfr_int(rec["file_name"]),
     }
 
-    lab_hits = labs[labs.study_id == rec.study_id]
+    for label in LAB_COLUMNS + HOSP_COLUMNS:
+        feature[label] = _tfr_float(rec[label])
 
-    if len(lab_hits) > 0:
-        lab_rec = lab_hits.iloc[0]
-        for label in ["troponin i", "potassium", "sodium"]:
-            feature[label] = _tfr_float(lab_rec[label])
-            feature[f"{label}_offset"] = _tfr_float(lab_rec[f"{label}_offset"])
-    else:
-        for label in ["troponin i", "potassium", "sodium"]:
-            feature[label] = _tfr_float(np.nan)
-            feature[f"{label}_offset"] = _tfr_float(np.nan)
+    return feature
 
-    hosp_hits = hosp[hosp.study_id == rec.study_id]
+def read_record(rec, quality = None):
+    """Read one record with wfdb.rdrecord; returns (None, None) if it fails
+    the checks.
 
-    if len(hosp_hits) > 0:
-        hosp_rec = hosp_hits.iloc[0]
+    If quality is a list, the record's quality statistics are appended to it
+    whether or not the record is valid.
+    """
+    r = wfdb.rdrecord(BASE_ECG_PATH / rec["path"], physical = False)
+    return check_record(rec, r, quality)
 
-        feature['hospital_expire_flag'] = _tfr_float(hosp_rec['hospital_expire_flag'])
-        feature['icu_expire_flag'] = _tfr_float(hosp_rec['icu_expire_flag'])
-        feature['ecg_offset'] = _tfr_float(hosp_rec['ecg_offset'])
-    else:
-        feature['hospital_expire_flag'] = _tfr_float(np.nan)
-        feature['icu_expire_flag'] = _tfr_float(np.nan)
-        feature['ecg_offset'] = _tfr_float(np.nan)
+def read_records(rows, quality = None, reader = None):
+    """read_record for each row, in order, through an ecg_reader.EcgReader if
+    one is given. Records the reader rejects (wrong shape or missing leads)
+    are invalid, with the reason in the quality 'error' column."""
+    if reader is None:
+        for rec in rows:
+            yield read_record(rec, quality)
+        return
+
+    for rec, (r, error) in zip(rows, reader.read_many([rec["path"] for rec in rows])):
+        if error is None:
+            yield check_record(rec, r, quality)
+            continue
+        if quality is not None:
+            quality.append({
+                'file_name': rec["file_name"],
+                'filename': rec["path"],
+                'age': rec["ecg_age"],
+                'valid': False,
+                **unread_quality(),
+                'error': str(error),
+            })
+        yield None, None
+
+def check_record(rec, r, quality = None):
+    """(r, physical signal) for a record that was read, or (None, None) if a
+    lead is flat or has missing samples."""
+    dat = r.dac(return_res = 64)
+    min = np.min(dat, axis=0)
+    max = np.max(dat, axis=0)
+    valid = not (np.any(min == max) or np.any(np.isnan(dat)))
+
+    if quality is not None:
+        quality.append({
+            'file_name': rec["file_name"],
+            'filename': rec["path"],
+            'age': rec["ecg_age"],
+            'valid': valid,
+            **record_quality(r, dat),
+        })
+
+    if not valid:
+        return None, None
+
+    return r, dat
+
+def wfdb_to_example(rec, fmt = 'float32', quality = None):
+    r, dat = read_record(rec, quality)
+    if r is None:
+        return None
+    return record_to_example(rec, r, dat, fmt)
+
+def record_to_example(rec, r, dat, fmt = 'float32'):
+    feature = encode_signal(fmt, dat, r.d_signal, r.adc_gain, r.baseline)
+    feature.update(label_features(rec))
 
     example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
-    return example_proto.SerializeToString() 
+    return example_proto.SerializeToString(deterministic = True)
+
+def output_file(output_path, target, file_count):
+    return str(Path(output_path) / f"{target}-{file_count:04}.tfrecords")
+
+def shard_ranges(n_rows, shard_size = SHARD_SIZE):
+    return [(shard, start, min(start + shard_size, n_rows))
+        for shard, start in enumerate(range(0, n_rows, shard_size))]
+
+_worker_state = {}
+
+def _init_worker(ecg_data, dataset, output_path, fmt, compression, reader_args = None, quality_path = QUALITY_PATH):
+    # each worker loads the header index itself rather than receiving a pickled reader
+    _worker_state.update(
+        ecg_data = ecg_data,
+        dataset = dataset,
+        output_path = output_path,
+        quality_path = quality_path,
+        fmt = fmt,
+        compression = compression,
+        reader = EcgReader(BASE_ECG_PATH, *reader_args) if reader_args else None,
+    )
+
+def _frame_hash(df, salt = ""):
+    h = hashlib.sha1(salt.encode())
+    h.update(pd.util.hash_pandas_object(df, index = False).values.tobytes())
+    return h.hexdigest()
+
+def shard_entry(ecg_data, shard, start, stop, fmt, compression, reader = 'wfdb'):
+    rows = ecg_data.iloc[start:stop]
+    # the mmap reader puts the leads in canonical order and rejects records of
+    # the wrong shape, so its shards are not interchangeable with rdrecord's
+    salt = f"signal-v{SIGNAL_VERSION}-{fmt}-{compression}" + ("" if reader == 'wfdb' else f"-{reader}")
+    return {
+        'shard': shard,
+        'start': start,
+        'stop': stop,
+        'format': fmt,
+        'compression': compression,
+        'schema': example_features(fmt),
+        'signal_hash': _frame_hash(rows[SIGNAL_COLUMNS], salt),
+        'label_hash': _frame_hash(rows[LABEL_COLUMNS]),
+    }
+
+def manifest_file(output_path, target):
+    return Path(output_path) / f"{target}-manifest.json"
 
-def output_file(target, file_count):
-    return str(OUTPUT_DATA_PATH / f"{target}-{file_count:04}.tfrecords")
+def load_manifest(output_path, target):
+    path = manifest_file(output_path, target)
+    if not path.exists():
+        return {}
+    with open(path) as fh:
+        return {int(k): v for k, v in json.load(fh)['shards'].items()}
 
+def save_manifest(output_path, target, shards, shard_size = SHARD_SIZE):
+    path = manifest_file(output_path, target)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump({
+            'dataset': target,
+            'shard_size': shard_size,
+            'shards': {f"{k:04}": {f: v for f, v in shards[k].items() if f != 'offsets'} for k in sorted(shards)},
+        }, fh, indent = 2)
+    os.replace(tmp_path, path)
 
-ecg_data = pd.read_csv(BASE_DATA_PATH / f"{args.dataset}_ecgs.csv")
-lab_data = pd.read_csv(BASE_DATA_PATH / "ecg_lab_results.csv")
-hosp_data = pd.read_csv(BASE_DATA_PATH / "ecg_hosp_results.csv")
+def previous_offsets(output_path, target, shards, compression):
+    """Record offsets of existing shards {shard: offsets}, from the last index
+    where it still matches the file and from the record headers otherwise."""
+    if compression != 'NONE':
+        return {shard: None for shard in shards}
+    indexed = {}
+    if index_file(output_path, target).exists():
+        indexed = {e['file']: e for e in load_index(output_path, target)['shards']}
+    offsets = {}
+    for shard in shards:
+        path = Path(output_file(output_path, target, shard))
+        entry = indexed.get(path.name)
+        if entry and entry['bytes'] == path.stat().st_size and entry.get('offsets') is not None:
+            offsets[shard] = entry['offsets']
+        else:
+            offsets[shard] = record_offsets(path)
+    return offsets
 
-record_count = 0
-file_count = 0
+def save_index(output_path, target, shards, fmt, compression):
+    """Write the loader index: per-shard file, record count, size and (for
+    uncompressed shards) the byte offset of every record."""
+    path = index_file(output_path, target)
+    tmp_path = path.with_suffix(".json.tmp")
+    entries = [{
+        'file': Path(output_file(output_path, target, k)).name,
+        'start': shards[k]['start'],
+        'stop': shards[k]['stop'],
+        'records': shards[k]['records'],
+        'bytes': shards[k]['bytes'],
+        'offsets': shards[k].get('offsets'),
+    } for k in sorted(shards)]
+    with open(tmp_path, "w") as fh:
+        json.dump({
+            'dataset': target,
+            'format': fmt,
+            'compression': compression,
+            'records': sum(e['records'] for e in entries),
+            'shards': entries,
+        }, fh)
+    os.replace(tmp_path, path)
 
-writer = tf.io.TFRecordWriter(output_file(args.dataset, file_count))
-for r in tqdm(ecg_data.itertuples(), total = args.first or len(ecg_data)):
-    ex = wfdb_to_example(r, lab_data, hosp_data)
-    if ex is not None:
+def remove_stale_shards(output_path, target, n_shards):
+    """Delete shard (or quality) files in output_path numbered n_shards or
+    above, left over from a run with a smaller shard size or more input rows."""
+    # shard numbers are zero-padded to four digits but may run past 9999
+    pattern = re.compile(rf"{re.escape(target)}-(\d+)[-.]")
+    for path in Path(output_path).glob(f"{target}-[0-9]*"):
+        match = pattern.match(path.name)
+        if match and int(match.group(1)) >= n_shards and path.suffix in (".tfrecords", ".parquet"):
+            path.unlink()
+
+def record_bytes(ecg_data, fmt, compression, sample = SHARD_SAMPLE):
+    """Mean stored size of a record, from serializing up to `sample` valid
+    records from the start of ecg_data (None if none are valid)."""
+    sizes = []
+    for rec in ecg_data.head(4 * sample).to_dict("records"):
+        ex = wfdb_to_example(rec, fmt)
+        if ex is None:
+            continue
+        if compression != 'NONE':
+            ex = zlib.compress(ex)
+        # TFRecord framing: 8 byte length and two 4 byte CRCs per record
+        sizes.append(len(ex) + 16)
+        if len(sizes) == sample:
+            break
+    return float(np.mean(sizes)) if sizes else None
+
+def choose_shard_size(ecg_data, args):
+    if args.shard_size is not None:
+        return args.shard_size
+    if args.shard_bytes is None:
+        return SHARD_SIZE
+    size = record_bytes(ecg_data, args.format, args.compression if args.layout == 'tfrecord' else 'NONE')
+    return SHARD_SIZE if size is None else max(1, int(args.shard_bytes // size))
+
+def plan_shard(entry, previous, output_path, target):
+    """Return 'skip', 'relabel' or 'build' for a shard given its manifest entry."""
+    path = Path(output_file(output_path, target, entry['shard']))
+    if previous is None or not path.exists() or path.stat().st_size != previous.get('bytes'):
+        return 'build'
+    if (previous['start'], previous['stop'], previous['signal_hash']) != (entry['start'], entry['stop'], entry['signal_hash']):
+        return 'build'
+    if previous['schema'] != entry['schema'] or previous['label_hash'] != entry['label_hash']:
+        return 'relabel'
+    return 'skip'
+
+def write_shard(task):
+    entry, mode = task
+    shard, start, stop = entry['shard'], entry['start'], entry['stop']
+    rows = _worker_state['ecg_data'].iloc[start:stop].to_dict("records")
+    path = output_file(_worker_state['output_path'], _worker_state['dataset'], shard)
+    tmp_path = f"{path}.tmp"
+    fmt = _worker_state['fmt']
+    options = record_options(_worker_state['compression'])
+
+    offsets = []
+    position = 0
+
+    def _write(writer, ex):
+        nonlocal position
+        offsets.append(position)
+        position += len(ex) + 16
         writer.write(ex)
-        record_count += 1
 
-    if record_count > SHARD_SIZE:
-        record_count = 0
-        file_count += 1
-        writer.close()
-        writer = tf.io.TFRecordWriter(output_file(args.dataset, file_count))
+    with tf.io.TFRecordWriter(tmp_path, options) as writer:
+        if mode == 'relabel':
+            # labels changed but the signals did not: reuse the stored signal
+            # features instead of re-reading every WFDB file in the shard
+            by_file_name = {r["file_name"]: r for r in rows}
+            for raw in tf.data.TFRecordDataset(path, compression_type = options.compression_type):
+                old = tf.train.Example.FromString(raw.numpy()).features.feature
+                feature = {k: old[k] for k in signal_feature_names(fmt)}
+                feature.update(label_features(by_file_name[old['file_name'].int64_list.value[0]]))
+                example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
+                _write(writer, example_proto.SerializeToString(deterministic = True))
+        else:
+            quality = []
+            for rec, (r, dat) in zip(rows, read_records(rows, quality, _worker_state['reader'])):
+                if r is not None:
+                    _write(writer, record_to_example(rec, r, dat, fmt))
+            write_quality(_worker_state['quality_path'], _worker_state['dataset'], shard, quality, rows)
+    os.replace(tmp_path, path)
+
+    # offsets are only seekable in uncompressed files
+    return dict(entry, records = len(offsets), bytes = os.path.getsize(path),
+        offsets = offsets if _worker_state['compression'] == 'NONE' else None)
+
+def write_store_shard(task):
+    shard, start, stop = task
+    rows = _worker_state['ecg_data'].iloc[start:stop].to_dict("records")
+    signals = np.zeros((len(rows), ecg_store.N_SAMPLES, ecg_store.N_LEADS), dtype = ecg_store.STORE_DTYPES[_worker_state['fmt']])
+    valid = np.zeros(len(rows), dtype = bool)
+    quality = []
+
+    for i, (r, dat) in enumerate(read_records(rows, quality, _worker_state['reader'])):
+        if r is None:
+            continue
+        # raw millivolts in the same memory layout as the TFRecord 'ecg/data' feature
+        signals[i] = dat.T.reshape(ecg_store.N_SAMPLES, ecg_store.N_LEADS)
+        valid[i] = True
+
+    ecg_store.write_rows(_worker_state['output_path'], _worker_state['dataset'], start, signals)
+    write_quality(_worker_state['quality_path'], _worker_state['dataset'], shard, quality, rows)
+    return start, stop, valid
+
+def store_labels(ecg_data, valid):
+    labels = pd.DataFrame({
+        'row': np.arange(len(ecg_data)),
+        'valid': valid,
+        'file_name': ecg_data['file_name'].values,
+        'study_id': ecg_data['study_id'].values,
+        'subject_id': ecg_data['subject_id'].values,
+        'path': ecg_data['path'].values,
+        'age': ecg_data['ecg_age'].values.astype(np.float32),
+        'gender': (ecg_data['gender'] == "M").astype(np.int64).values,
+    })
+    for label in LAB_COLUMNS + HOSP_COLUMNS:
+        labels[label] = ecg_data[label].values.astype(np.float32)
+    return labels
+
+def run_tasks(fn, tasks, init_args, workers):
+    if workers > 1:
+        # spawn rather than fork: TensorFlow's runtime is not fork-safe
+        with get_context("spawn").Pool(workers, initializer = _init_worker, initargs = init_args) as pool:
+            yield from pool.imap_unordered(fn, tasks)
+    else:
+        _init_worker(*init_args)
+        for task in tasks:
+            yield fn(task)
+
+def build_store(ecg_data, init_args, args):
+    ecg_store.create_store(args.output, args.dataset, len(ecg_data), args.format)
+
+    valid = np.zeros(len(ecg_data), dtype = bool)
+    progress = tqdm(total = len(ecg_data))
+    for start, stop, shard_valid in run_tasks(write_store_shard, shard_ranges(len(ecg_data), args.shard_size),
+            init_args, args.workers):
+        valid[start:stop] = shard_valid
+        progress.update(stop - start)
+    progress.close()
+
+    ecg_store.write_labels(args.output, args.dataset, store_labels(ecg_data, valid))
+
+def main():
+    parser = ArgumentParser(
+        prog = "preprocess_data.py",
+        description = "Convert WFDB records and outcome labels to sharded TFRecords or a memmap store"
+    )
+
+    parser.add_argument("--dataset", action = "store", required = True, choices = ['test', 'train', 'val'])
+    parser.add_argument("--output", action = "store", required = True)
+    parser.add_argument("--first", action = "store", type=int, help = "only process the first N input rows")
+    parser.add_argument("--quality", action = "store", default = QUALITY_PATH,
+        help = "directory for the per-shard data quality files, as read by show_data_quality.py")
+    parser.add_argument("--workers", action = "store", type=int, default = 1)
+    parser.add_argument("--format", action = "store", choices = FORMATS, default = 'float32',
+        help = "storage type for the ECG signal, see ecg_records.py")
+    parser.add_argument("--compression", action = "store", choices = COMPRESSION, default = 'NONE')
+    parser.add_argument("--layout", action = "store", choices = ['tfrecord', 'memmap'], default = 'tfrecord',
+        help = "write sharded TFRecords or a memory-mapped store (see ecg_store.py)")
+    parser.add_argument("--rebuild", action = "store_true", help = "ignore the manifest and rebuild every shard")
+    parser.add_argument("--shard-size", action = "store", type=int, help = f"input rows per shard (default {SHARD_SIZE})")
+    parser.add_argument("--shard-bytes", action = "store", type=int,
+        help = "target shard size in bytes; rows per shard are estimated from a sample of records")
+    parser.add_argument("--reader", action = "store", choices = ['mmap', 'wfdb'], default = 'mmap',
+        help = "read records with ecg_reader.EcgReader (canonical lead order, cached headers) or wfdb.rdrecord")
+    parser.add_argument("--header-index", action = "store", default = DEFAULT_HEADER_INDEX)
+    parser.add_argument("--read-threads", action = "store", type = int, default = 4,
+        help = "threads reading records in each worker")
+    args = parser.parse_args()
+
+    ecg_data = read_split(BASE_DATA_PATH, args.dataset, columns = ECG_COLUMNS)
+    lab_data = read_table(BASE_DATA_PATH, "ecg_lab_results", columns = ["study_id"] + LAB_COLUMNS)
+    hosp_data = read_table(BASE_DATA_PATH, "ecg_hosp_results", columns = ["study_id"] + HOSP_COLUMNS)
+
+    if args.first is not None:
+        ecg_data = ecg_data.head(args.first)
+    ecg_data = attach_labels(ecg_data, lab_data, hosp_data)
+    args.shard_size = choose_shard_size(ecg_data, args)
+    print(f"{args.shard_size} input rows per shard")
+    reader_args = None
+    if args.reader == 'mmap':
+        EcgReader(BASE_ECG_PATH, args.header_index, args.read_threads * args.workers).update_index(ecg_data['path'])
+        reader_args = (args.header_index, args.read_threads)
+    init_args = (ecg_data, args.dataset, args.output, args.format, args.compression, reader_args, args.quality)
+    remove_stale_shards(args.quality, args.dataset, len(shard_ranges(len(ecg_data), args.shard_size)))
+
+    if args.layout == 'memmap':
+        build_store(ecg_data, init_args, args)
+        return
+
+    previous = {} if args.rebuild else load_manifest(args.output, args.dataset)
+    shards = {}
+    tasks = []
+    ranges = shard_ranges(len(ecg_data), args.shard_size)
+    remove_stale_shards(args.output, args.dataset, len(ranges))
+    for shard, start, stop in ranges:
+        entry = shard_entry(ecg_data, shard, start, stop, args.format, args.compression, args.reader)
+        mode = plan_shard(entry, previous.get(shard), args.output, args.dataset)
+        if mode == 'skip':
+            shards[shard] = previous[shard]
+        else:
+            tasks.append((entry, mode))
+    for shard, offsets in previous_offsets(args.output, args.dataset, list(shards), args.compression).items():
+        shards[shard] = dict(shards[shard], offsets = offsets)
+
+    print(f"{len(shards)} shards up to date, "
+        f"{sum(mode == 'relabel' for _, mode in tasks)} to relabel, "
+        f"{sum(mode == 'build' for _, mode in tasks)} to build")
+
+    saved = time.monotonic()
+
+    def _finished(entry):
+        nonlocal saved
+        shards[entry['shard']] = entry
+        if time.monotonic() - saved >= MANIFEST_SECONDS:
+            save_manifest(args.output, args.dataset, shards, args.shard_size)
+            saved = time.monotonic()
+        progress.update(entry['stop'] - entry['start'])
+
+    progress = tqdm(total = sum(entry['stop'] - entry['start'] for entry, _ in tasks))
+    for entry in run_tasks(write_shard, tasks, init_args, args.workers):
+        _finished(entry)
+    progress.close()
 
-    if args.first is not None and (file_count * SHARD_SIZE + record_count) > args.first:
-        break
+    save_manifest(args.output, args.dataset, shards, args.shard_size)
+    save_index(args.output, args.dataset, shards, args.format, args.compression)
 
-writer.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
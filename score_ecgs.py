@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Score every ECG in a set of TFRecord shards with one or more trained models.
+#
+# Each shard is read and decoded once and every model that needs (re)scoring
+# is run over each decoded batch. Scores are written per shard to
+# {output}/{shard}.parquet with a file_name column and one column per model
+# ({model}/{task} per task for a multi-task model from train_multitask.py).
+# A model is rescored on a shard when its column is missing, when either the
+# model or the shard is newer than the shard's score file, or when the score
+# was written with another --runtime, --normalize or --crops (kept per model
+# in the score file's Parquet metadata).
+#
+# Models trained on crops or resampled signals have an augmentation config
+# saved next to them (ecg_augment.augment_file); their score is the mean over
+# --crops evenly spaced crops, or the center crop with --crops 1.
+
+import pandas as pd
+from pathlib import Path
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+from tqdm import tqdm
+from argparse import ArgumentParser
+import os
+
+from ecg_pipeline import read_records, parse_batch, dataset_stats
+from ecg_records import FORMATS, COMPRESSION, NORMALIZATIONS
+from ecg_tflite import TFLiteModel
+from ecg_augment import augment_file, load_config, multi_crop
+
+MODELS = ['resnet-age', 'cnn-age', 'resnet-potassium', 'cnn-potassium', 'cnn-gender', 'resnet-gender', 'cnn-sodium', 'resnet-sodium']
+SETTINGS_KEY = b"ecg_score_settings"
+
+def model_file(model_dir, model_name, runtime = 'keras'):
+    return Path(model_dir) / f"{model_name}.{'tflite' if runtime == 'tflite' else 'keras'}"
+
+def load_model(model_dir, model_name, runtime = 'keras'):
+    path = model_file(model_dir, model_name, runtime)
+    if runtime == 'tflite':
+        return TFLiteModel(path)
+    return tf.keras.models.load_model(str(path))
+
+def load_augment(model_dir, model_name):
+    path = augment_file(model_dir, model_name)
+    return load_config(path) if path.exists() else None
+
+def output_scores(out, n_crops = 1):
+    """[B] scores from a model's output on n_crops crops of B ECGs (crop
+    major), averaged over the crops; {task: [B] scores} for a multi-task
+    model, which returns a dict."""
+    if isinstance(out, dict):
+        return {k: output_scores(v, n_crops) for k, v in out.items()}
+    out = np.asarray(out, dtype = np.float64)
+    return out.reshape(n_crops, -1, out.shape[-1])[:, :, 0].mean(axis = 0)
+
+def score_columns(name, scores):
+    """{column: scores} for output_scores of model name: one column named
+    after the model, or {name}/{task} for each task of a multi-task model."""
+    return {f"{name}/{k}": v for k, v in scores.items()} if isinstance(scores, dict) else {name: scores}
+
+def column_model(column):
+    return column.split("/")[0]
+
+def predict(model, ecg, augment = None, crops = 1):
+    """output_scores for a decoded batch; with an augmentation config, the
+    mean over crops evenly spaced crops of each ECG."""
+    if augment is None:
+        return output_scores(model(ecg, training = False))
+    x = multi_crop(ecg, augment, crops)
+    return output_scores(model(tf.reshape(x, [-1, *x.shape[2:]]), training = False), x.shape[0])
+
+def score_file(output_path, shard):
+    return Path(output_path) / f"{Path(shard).stem}.parquet"
+
+def score_settings(runtime = 'keras', normalize = 'zscore', augment = None, crops = 1):
+    """What a model's scores depend on besides the model and the shard;
+    crops only matter for models with an augmentation config."""
+    return {'runtime': runtime, 'normalize': normalize, 'crops': crops if augment else None}
+
+def read_settings(path):
+    """{model: score_settings} stored in a score file (empty for old files)."""
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata.get(SETTINGS_KEY, b"{}"))
+
+def stale_models(shard, models, model_dir, output_path, runtime = 'keras', settings = None):
+    """Models in models to (re)score on shard. settings maps a model to its
+    current score_settings; defaults to score_settings(runtime)."""
+    path = score_file(output_path, shard)
+    if not path.exists():
+        return list(models)
+    settings = settings or {}
+    previous = read_settings(path)
+
+    scored_at = path.stat().st_mtime
+    columns = {column_model(c) for c in pq.read_schema(path).names}
+    if Path(shard).stat().st_mtime >= scored_at:
+        return list(models)
+
+    def _augment_changed(m):
+        path = augment_file(model_dir, m)
+        return path.exists() and path.stat().st_mtime >= scored_at
+
+    return [m for m in models
+        if m not in columns or model_file(model_dir, m, runtime).stat().st_mtime >= scored_at or _augment_changed(m)
+        or previous.get(m) != settings.get(m, score_settings(runtime))]
+
+def score_shard(shard, models, batch_size, fmt, compression, normalize = 'zscore', global_stats = None,
+        augments = None, crops = 1):
+    dataset = read_records([shard], compression, interleave = 1, deterministic = True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda r: parse_batch(r, ['file_name'], fmt, normalize, global_stats),
+        num_parallel_calls = tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    file_names = []
+    scores = {}
+    for ecg, values in dataset:
+        file_names.append(values['file_name'].numpy())
+        for name, model in models.items():
+            for column, value in score_columns(name, predict(model, ecg, (augments or {}).get(name), crops)).items():
+                scores.setdefault(column, []).append(value)
+
+    result = pd.DataFrame({'file_name': np.concatenate(file_names) if file_names else np.zeros(0, dtype = np.int64)})
+    for name in models:
+        if not file_names:
+            result[name] = np.zeros(0, dtype = np.float32)
+    for column, values in scores.items():
+        result[column] = np.concatenate(values).astype(np.float32)
+    return result
+
+def write_scores(output_path, shard, result, settings):
+    """Write result's scores for shard, keeping the other models' columns and
+    settings from the existing score file. settings maps each model in result
+    to its score_settings."""
+    path = score_file(output_path, shard)
+    settings = dict(settings)
+    if path.exists():
+        previous = pd.read_parquet(path)
+        rescored = {column_model(c) for c in result.columns}
+        keep = [c for c in previous.columns if column_model(c) not in rescored]
+        if keep:
+            result = result.merge(previous[['file_name'] + keep], on = 'file_name', how = 'left')
+            previous_settings = read_settings(path)
+            settings.update({column_model(c): previous_settings[column_model(c)] for c in keep
+                if column_model(c) in previous_settings})
+    table = pa.Table.from_pandas(result, preserve_index = False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SETTINGS_KEY] = json.dumps(settings).encode()
+    tmp_path = path.with_suffix(".parquet.tmp")
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = ArgumentParser(
+        prog = "score_ecgs.py",
+        description = "Score TFRecord shards with trained models"
+    )
+
+    parser.add_argument("--data", action = "store", default = "/scratch/ajb5d/ecg/tfrecords/")
+    parser.add_argument("--pattern", action = "store", default = "*.tfrecords")
+    parser.add_argument("--models", action = "store", nargs = "+", default = MODELS)
+    parser.add_argument("--model-dir", action = "store", default = "data/models")
+    parser.add_argument("--runtime", action = "store", choices = ['keras', 'tflite'], default = 'keras',
+        help = "score with {model}.keras or with {model}.tflite from export_model.py")
+    parser.add_argument("--output", action = "store", default = "data/scores")
+    parser.add_argument("--batch-size", action = "store", type = int, default = 512)
+    parser.add_argument("--format", action = "store", choices = FORMATS, default = 'float32')
+    parser.add_argument("--compression", action = "store", choices = COMPRESSION, default = 'NONE')
+    parser.add_argument("--normalize", action = "store", choices = NORMALIZATIONS, default = 'zscore',
+        help = "must match the normalization the models were trained with")
+    parser.add_argument("--stats-pattern", action = "store", default = "train*.tfrecords",
+        help = "shards in --data to take the per-lead statistics from for --normalize global")
+    parser.add_argument("--crops", action = "store", type = int, default = 1,
+        help = "for models trained on crops, average over this many evenly spaced crops per ECG")
+    parser.add_argument("--combine", action = "store", help = "also write all shard scores to this parquet file")
+    args = parser.parse_args()
+
+    Path(args.output).mkdir(parents = True, exist_ok = True)
+    shards = sorted(Path(args.data).glob(args.pattern))
+
+    global_stats = None
+    if args.normalize == 'global':
+        global_stats = dataset_stats(sorted(Path(args.data).glob(args.stats_pattern)), args.compression)
+
+    loaded = {}
+    augments = {name: load_augment(args.model_dir, name) for name in args.models}
+    settings = {name: score_settings(args.runtime, args.normalize, augments[name], args.crops) for name in args.models}
+    for shard in tqdm(shards):
+        needed = stale_models(shard, args.models, args.model_dir, args.output, args.runtime, settings)
+        if not needed:
+            continue
+
+        for name in needed:
+            if name not in loaded:
+                loaded[name] = load_model(args.model_dir, name, args.runtime)
+
+        result = score_shard(shard, {name: loaded[name] for name in needed}, args.batch_size,
+            args.format, args.compression, args.normalize, global_stats, augments, args.crops)
+        write_scores(args.output, shard, result, {name: settings[name] for name in needed})
+
+    if args.combine:
+        pd.concat([pd.read_parquet(score_file(args.output, s)) for s in shards]).to_parquet(args.combine, index = False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Local inference service for single ECGs.
+#
+#   python serve_ecgs.py --models resnet-age resnet-gender --port 8050
+#   python serve_ecgs.py --socket /tmp/ecg.sock
+#
+# POST /predict with a JSON body holding one of
+#
+#   {"path": "files/p1000/p10000032/s40689238/40689238"}   WFDB record, relative
+#                                                          to BASE_ECG_PATH or absolute
+#   {"signal": [[...12 values...], ...5000 rows...]}        samples x leads, millivolts
+#
+# Records are read with ecg_reader.EcgReader, which puts the leads in
+# CANONICAL_SIG_ORDER as in the TFRecords the models were trained on; the
+# columns of a "signal" must already be in that order (I, II, III, aVR, aVF,
+# aVL, V1-V6).
+# and get back {"predictions": {model: value}, "latency_ms": ...}. Signals are
+# checked and normalized exactly as in preprocessing/training. Requests are
+# queued and run through every model in micro-batches of up to --max-batch,
+# waiting at most --max-wait-ms for a batch to fill. GET /stats reports the
+# p50/p99 request latency against --p99-target-ms; GET /health lists models.
+# Models trained on crops or resampled signals are fed crops as in
+# score_ecgs.py: the mean over --crops evenly spaced crops of each ECG.
+
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from argparse import ArgumentParser
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from preprocess_data import BASE_ECG_PATH, check_record
+from ecg_reader import EcgReader
+from ecg_records import N_SAMPLES, N_LEADS, NORMALIZATIONS, STAT_FEATURES, signal_stats, normalize_signal
+from ecg_pipeline import dataset_stats
+from score_ecgs import MODELS, model_file, load_augment, output_scores, score_columns
+from ecg_augment import input_shape, multi_crop
+
+LATENCY_WINDOW = 10000
+
+class Request:
+    def __init__(self, signal):
+        self.signal = signal
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Batcher:
+    """Runs queued signals through every model in micro-batches on one thread."""
+
+    def __init__(self, models, normalize = 'zscore', global_stats = None, max_batch = 32, max_wait_ms = 5.0,
+            augments = None, crops = 1):
+        self.models = models
+        self.augments = augments or {}
+        self.crops = crops
+        self.normalize = normalize
+        self.global_stats = global_stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen = LATENCY_WINDOW)
+
+        self._predict = {name: tf.function(lambda x, m = model: m(x, training = False),
+            input_signature = [tf.TensorSpec([None, *self._input_shape(name)], tf.float32)])
+            for name, model in models.items()}
+        # trace and allocate once so the first request is not slow
+        self._run(np.zeros((1, N_SAMPLES, N_LEADS), dtype = np.float32))
+        threading.Thread(target = self._loop, daemon = True).start()
+
+    def submit(self, signal, timeout = 30):
+        request = Request(signal)
+        self.queue.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError("prediction timed out")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _input_shape(self, name):
+        augment = self.augments.get(name)
+        return input_shape(augment) if augment else (N_SAMPLES, N_LEADS)
+
+    def _prepare(self, signals):
+        # lead-major like the TFRecords, normalized with the same statistics
+        flat = np.stack([s.T.reshape(-1) for s in signals]).astype(np.float32)
+        stats = signal_stats(np.stack(signals))
+        stats = {k: tf.constant(stats[k], dtype = tf.float32) for k in STAT_FEATURES}
+        flat = normalize_signal(tf.constant(flat), stats, self.normalize, self.global_stats)
+        return tf.reshape(flat, [-1, N_SAMPLES, N_LEADS])
+
+    def _run(self, x):
+        results = {}
+        for name, predict in self._predict.items():
+            augment = self.augments.get(name)
+            if augment is None:
+                n_crops, out = 1, predict(x)
+            else:
+                crops = multi_crop(x, augment, self.crops)
+                n_crops, out = crops.shape[0], predict(tf.reshape(crops, [-1, *crops.shape[2:]]))
+            results.update(score_columns(name, output_scores(out, n_crops)))
+        return results
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout = remaining))
+                except queue.Empty:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self._run(self._prepare([r.signal for r in batch]))
+                for i, request in enumerate(batch):
+                    request.result = {key: float(values[i]) for key, values in results.items()}
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+def load_signal(body, reader):
+    """[5000, 12] physical signal in canonical lead order from a request body,
+    or a ValueError."""
+    if 'path' in body:
+        r, dat = check_record(None, reader.read(body['path']))
+        if r is None:
+            raise ValueError("record failed the quality checks (flat or missing leads)")
+    elif 'signal' in body:
+        dat = np.asarray(body['signal'], dtype = np.float64)
+        if not np.all(np.isfinite(dat)):
+            raise ValueError("signal has missing values")
+    else:
+        raise ValueError("request needs a 'path' or a 'signal'")
+
+    if dat.shape != (N_SAMPLES, N_LEADS):
+        raise ValueError(f"expected a {N_SAMPLES} x {N_LEADS} signal, got {' x '.join(map(str, dat.shape))}")
+    if np.any(np.min(dat, axis = 0) == np.max(dat, axis = 0)):
+        raise ValueError("signal has a flat lead")
+    return dat
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "serve_ecgs"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send(200, {'status': 'ok', 'models': list(service.batcher.models)})
+        elif self.path == "/stats":
+            self._send(200, service.stats())
+        else:
+            self._send(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send(404, {'error': f"unknown path {self.path}"})
+            return
+
+        service = self.server.service
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            predictions = service.batcher.submit(load_signal(body, service.reader))
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+
+        latency = (time.perf_counter() - start) * 1000
+        service.latencies.append(latency)
+        self._send(200, {'predictions': predictions, 'latency_ms': latency})
+
+class Service:
+    def __init__(self, batcher, p99_target_ms, reader = None):
+        self.batcher = batcher
+        self.reader = reader or EcgReader(BASE_ECG_PATH, threads = 1)
+        self.p99_target_ms = p99_target_ms
+        self.latencies = deque(maxlen = LATENCY_WINDOW)
+
+    def stats(self):
+        latencies = np.array(self.latencies)
+        batch_sizes = np.array(self.batcher.batch_sizes)
+        if not len(latencies):
+            return {'requests': 0, 'p99_target_ms': self.p99_target_ms}
+        p99 = float(np.percentile(latencies, 99))
+        return {
+            'requests': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': p99,
+            'p99_target_ms': self.p99_target_ms,
+            'within_target': p99 <= self.p99_target_ms,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+        }
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    parser = ArgumentParser(
+        prog = "serve_ecgs.py",
+        description = "Serve predictions for single ECGs over HTTP or a Unix socket"
+    )
+
+    parser.add_argument("--models", action = "store", nargs = "+", default = MODELS)
+    parser.add_argument("--model-dir", action = "store", default = "data/models")
+    parser.add_argument("--host", action = "store", default = "127.0.0.1")
+    parser.add_argument("--port", action = "store", type = int, default = 8050)
+    parser.add_argument("--socket", action = "store", help = "listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch", action = "store", type = int, default = 32)
+    parser.add_argument("--max-wait-ms", action = "store", type = float, default = 5.0,
+        help = "how long the first request in a batch waits for others")
+    parser.add_argument("--p99-target-ms", action = "store", type = float, default = 250.0)
+    parser.add_argument("--normalize", action = "store", choices = NORMALIZATIONS, default = 'zscore',
+        help = "must match the normalization the models were trained with")
+    parser.add_argument("--crops", action = "store", type = int, default = 1,
+        help = "for models trained on crops, average over this many evenly spaced crops per ECG")
+    parser.add_argument("--stats-data", action = "store", default = "/scratch/ajb5d/ecg/tfrecords/",
+        help = "train*.tfrecords here give the per-lead statistics for --normalize global")
+    args = parser.parse_args()
+
+    models = {name: tf.keras.models.load_model(str(model_file(args.model_dir, name))) for name in args.models}
+    global_stats = None
+    if args.normalize == 'global':
+        global_stats = dataset_stats(sorted(Path(args.stats_data).glob("train*.tfrecords")))
+    augments = {name: load_augment(args.model_dir, name) for name in args.models}
+    batcher = Batcher(models, args.normalize, global_stats, args.max_batch, args.max_wait_ms, augments, args.crops)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        where = f"http://{args.host}:{args.port}"
+    server.service = Service(batcher, args.p99_target_ms)
+
+    print(f"Serving {', '.join(models)} on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,56 @@
 import pandas as pd
+from pathlib import Path
+from collections import Counter
+from argparse import ArgumentParser
+
+from ecg_quality import QUALITY_PATH
+
+parser = ArgumentParser(
+    prog = "show_data_quality.py",
+    description = "Aggregate the per-shard data quality files"
+)
+parser.add_argument("--input", action = "store", nargs = "+", default = [QUALITY_PATH],
+    help = "directories holding {dataset}-NNNN-quality.parquet files")
+args = parser.parse_args()
 
 datasets = ['train', 'test', 'val']
 
-result = []
+# running totals so only one shard is in memory at a time
+n_total = 0
+true_counts = Counter()
+nan_counts = Counter()
+fs_counts = Counter()
+columns = {}
+
 for d in datasets:
-    dat = pd.read_csv(f"data/{d}_data_quality.csv")
-    print(f"Read {d} with {len(dat)} records")
-    dat['source'] = d
-    result.append(dat)
+    files = sorted(f for path in args.input for f in Path(path).glob(f"{d}-*-quality.parquet"))
+    n = 0
+    for f in files:
+        dat = pd.read_parquet(f)
+        n += len(dat)
+        fs_counts.update(dat['fs'].value_counts().to_dict())
+        for col in dat.columns:
+            # nullable "boolean" in files where some rows have no value
+            if dat[col].dtype in ("bool", "boolean"):
+                columns.setdefault(col, "bool")
+                true_counts[col] += dat[col].sum()
+            if dat[col].dtype == "float64":
+                columns.setdefault(col, "float64")
+                nan_counts[col] += dat[col].isna().sum()
+    print(f"Read {d} with {n} records from {len(files)} shards")
+    n_total += n
 
-dat = pd.concat(result)
+if n_total == 0:
+    raise SystemExit("no quality files found")
 
-for col in dat.columns:
-    if dat[col].dtype == "bool":
-        m = dat[col].mean()
-        print(f"{col:10}       {m*100:0.2f}%")
+for col, dtype in columns.items():
+    if dtype == "bool":
+        m = true_counts[col] / n_total
+        print(f"{col:16} {m*100:0.2f}%")
 
-    if dat[col].dtype == "float64":
-        m = dat[col].isna().mean()
-        print(f"{col:10}       {m*100:0.2f}%")
+    if dtype == "float64":
+        m = nan_counts[col] / n_total
+        print(f"{col:16} {m*100:0.2f}% missing")
 
+for fs, count in sorted(fs_counts.items()):
+    print(f"fs = {fs:<10} {count / n_total * 100:0.2f}%")
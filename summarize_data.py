@@ -1,58 +1,81 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-from pathlib import Path
-import wfdb
-
-import numpy as np
 from tqdm import tqdm
 from argparse import ArgumentParser
+from multiprocessing import get_context
+
+from ecg_quality import QUALITY_PATH, quality_hash, records_hash, write_quality
+from preprocess_data import BASE_DATA_PATH, BASE_ECG_PATH, SHARD_SIZE, read_records, shard_ranges, remove_stale_shards
+from ecg_reader import EcgReader, DEFAULT_HEADER_INDEX
+from ecg_tables import read_split
+
+# preprocess_data.py writes the same per-shard quality files as a side effect
+# of serialization (both default to QUALITY_PATH); this script is for
+# scanning without writing TFRecords.
+
+_worker_state = {}
+
+def _init_worker(reader_args):
+    _worker_state['reader'] = EcgReader(BASE_ECG_PATH, *reader_args) if reader_args else None
+
+def summarize_shard(task):
+    dataset, output_path, shard, rows = task
+    quality = []
+    for _ in read_records(rows, quality, _worker_state['reader']):
+        pass
+    write_quality(output_path, dataset, shard, quality, rows)
+    return len(rows)
+
+def main():
+    parser = ArgumentParser(
+        prog = "summarize_data.py",
+        description = "Summarize and report data quality"
+    )
+
+    parser.add_argument("--dataset", action = "store", required = True, choices = ['test', 'train', 'val'])
+    parser.add_argument("--head", action = "store_true")
+    parser.add_argument("--output", action = "store", default = QUALITY_PATH)
+    parser.add_argument("--workers", action = "store", type=int, default = 1)
+    parser.add_argument("--shard-size", action = "store", type=int, default = SHARD_SIZE,
+        help = "input rows per shard; match preprocess_data.py to reuse its quality files")
+    parser.add_argument("--reader", action = "store", choices = ['mmap', 'wfdb'], default = 'mmap',
+        help = "read records with ecg_reader.EcgReader or wfdb.rdrecord")
+    parser.add_argument("--header-index", action = "store", default = DEFAULT_HEADER_INDEX)
+    parser.add_argument("--read-threads", action = "store", type = int, default = 4)
+
+    args = parser.parse_args()
+
+    ecg_data = read_split(BASE_DATA_PATH, args.dataset, columns = ['file_name', 'path', 'ecg_age'])
+    if args.head:
+        ecg_data = ecg_data.head(10)
+
+    # shards already scanned for the same records (by this script or
+    # preprocess_data.py) are skipped; files from a --head run, another
+    # --shard-size or before the split changed describe other records and
+    # are rescanned
+    ranges = shard_ranges(len(ecg_data), args.shard_size)
+    remove_stale_shards(args.output, args.dataset, len(ranges))
+    tasks = []
+    for shard, start, stop in ranges:
+        rows = ecg_data.iloc[start:stop].to_dict("records")
+        if quality_hash(args.output, args.dataset, shard) != records_hash(rows):
+            tasks.append((args.dataset, args.output, shard, rows))
+
+    reader_args = None
+    if args.reader == 'mmap':
+        EcgReader(BASE_ECG_PATH, args.header_index, args.read_threads * args.workers).update_index(ecg_data['path'])
+        reader_args = (args.header_index, args.read_threads)
+
+    progress = tqdm(total = sum(len(task[-1]) for task in tasks))
+    if args.workers > 1:
+        with get_context("spawn").Pool(args.workers, initializer = _init_worker, initargs = (reader_args,)) as pool:
+            for n_rows in pool.imap_unordered(summarize_shard, tasks):
+                progress.update(n_rows)
+    else:
+        _init_worker(reader_args)
+        for task in tasks:
+            progress.update(summarize_shard(task))
+    progress.close()
 
-BASE_ECG_PATH = Path("/scratch/ajb5d/ecg/mimic-iv-ecg-diagnostic-electrocardiogram-matched-subset-1.0/")
-BASE_DATA_PATH = Path("./data/")
-OUTPUT_DATA_PATH = Path('/scratch/ajb5d/ecg/tfrecords')
-
-parser = ArgumentParser(
-    prog = "summarize_data.py",
-    description = "Summarize and report data quality"
-)
-
-parser.add_argument("--dataset", action = "store", required = True, choices = ['test', 'train', 'val'])
-parser.add_argument("--head", action = "store_true")
-
-args = parser.parse_args()
-
-import tensorflow as tf
-
-CANONICAL_SIG_ORDER = ['I', 'II', 'III', 'aVR', 'aVF', 'aVL', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
-
-def wfdb_to_summary(rec):
-    r = wfdb.rdrecord(BASE_ECG_PATH / rec.path)
-    dat = r.p_signal
-    min_sig = np.min(dat, axis=0)
-    max_sig = np.max(dat, axis=0)
-    
-    ret_val =  {
-        'filename': rec.path,
-        'age': rec.ecg_age,
-        'fs': r.fs,
-        'mean': np.mean(dat),
-        'sd': np.std(dat),
-        'all_zeros': np.any(min_sig == max_sig),
-        'any_nan': np.any(np.isnan(dat))
-    }
-
-    return ret_val
-
-results = []
-ecg_data = pd.read_csv(BASE_DATA_PATH / f"{args.dataset}_ecgs.csv")
-record_count = 0
-
-for r in tqdm(ecg_data.itertuples(), total = len(ecg_data)):
-    ex = wfdb_to_summary(r)
-    results.append(ex)
-    record_count += 1
-    if args.head and record_count >= 10:
-        break
-
-pd.DataFrame(results).to_csv(f"data/{args.dataset}_data_quality.csv", index = False)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# Data-parallel training of the train_multitask.py models on several worker
+# processes with tf.distribute.MultiWorkerMirroredStrategy.
+#
+# Every worker holds a copy of the model and reads its own share of the
+# training shards (worker_files); gradients are all-reduced each step.
+# --batch-size is per replica, so the global batch grows with the number of
+# workers and devices. Under SLURM, start one process per task with srun (see
+# train_distributed.slurm); the cluster is read from the SLURM_* variables
+# (slurm_cluster). To test on one machine,
+#
+#   python train_distributed.py --local-workers 2 --data data/tfrecords --epochs 1
+#
+# starts two CPU-only workers on localhost. A TF_CONFIG already in the
+# environment is used as is.
+#
+# Keras 3's fit() cannot take input distributed by a MultiWorkerMirroredStrategy,
+# so with Keras 3 fit below runs model.train_step and test_step under
+# strategy.run and calls the callbacks itself; Keras 2 (the tensorflow 2.10
+# container in train_distributed.slurm) uses model.fit. Each worker's dataset
+# repeats, and an epoch is steps_per_epoch global batches (about one pass over
+# the training records), so no worker runs out of data before the others.
+# Only the first worker keeps checkpoints and the final model.
+
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+from argparse import ArgumentParser
+import tensorflow as tf
+
+from ecg_pipeline import get_multitask_dataset, indexed_counts, read_records
+from ecg_models import make_checkpoint_dir, resnet_backbone, transformer_backbone
+from ecg_records import N_SAMPLES, N_LEADS
+from ecg_training import set_training_mode, EpochTimer
+from ecg_augment import input_shape, augment_file, save_config
+from train_multitask import build_model, add_training_arguments, parse_loss_weights, augment_options, dataset_options
+
+KERAS_3 = int(tf.keras.__version__.split(".")[0]) >= 3
+
+COMMUNICATION = {
+    'auto': tf.distribute.experimental.CommunicationImplementation.AUTO,
+    'ring': tf.distribute.experimental.CommunicationImplementation.RING,
+    'nccl': tf.distribute.experimental.CommunicationImplementation.NCCL,
+}
+
+def expand_hostlist(hostlist):
+    """Host names in a SLURM hostlist such as 'udc-an[28-29,33],udc-ba01'."""
+    hosts = []
+    for prefix, ranges in re.findall(r"([^,\[]+)(?:\[([^\]]*)\])?", hostlist):
+        if not ranges:
+            hosts.append(prefix)
+            continue
+        for part in ranges.split(","):
+            start, _, stop = part.partition("-")
+            hosts.extend(f"{prefix}{i:0{len(start)}d}" for i in range(int(start), int(stop or start) + 1))
+    return hosts
+
+def expand_tasks_per_node(tasks):
+    """Tasks on each node from a SLURM count list such as '2(x3),1'."""
+    counts = []
+    for count, repeat in re.findall(r"(\d+)(?:\(x(\d+)\))?", tasks):
+        counts.extend([int(count)] * int(repeat or 1))
+    return counts
+
+def slurm_cluster(port):
+    """(worker addresses, this task's index) for the current srun step. Tasks
+    on a node listen on consecutive ports from port; task ranks are assumed to
+    be assigned node by node (SLURM's default block distribution)."""
+    hosts = expand_hostlist(os.environ.get("SLURM_STEP_NODELIST") or os.environ["SLURM_JOB_NODELIST"])
+    tasks = expand_tasks_per_node(os.environ.get("SLURM_STEP_TASKS_PER_NODE") or os.environ["SLURM_TASKS_PER_NODE"])
+    workers = [f"{host}:{port + i}" for host, n in zip(hosts, tasks) for i in range(n)]
+    return workers, int(os.environ["SLURM_PROCID"])
+
+def tf_config(workers, index):
+    return json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}})
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def run_local_workers(n_workers):
+    """Run this command as n_workers CPU-only workers on localhost; returns
+    the first non-zero exit status, stopping the others when one fails."""
+    workers = [f"localhost:{port}" for port in free_ports(n_workers)]
+    procs = [subprocess.Popen([sys.executable, *sys.argv],
+        env = dict(os.environ, TF_CONFIG = tf_config(workers, index), CUDA_VISIBLE_DEVICES = "-1"))
+        for index in range(n_workers)]
+    try:
+        # a worker that exits early leaves the rest waiting on it in a collective
+        while any(p.poll() is None for p in procs) and not any(p.returncode for p in procs):
+            time.sleep(1)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+    return next((p.returncode for p in procs if p.returncode), 0)
+
+def worker_files(filenames, index, count):
+    """Worker index's share of filenames: every count-th file from index."""
+    if len(filenames) < count:
+        raise ValueError(f"{len(filenames)} shards cannot be split across {count} workers")
+    return filenames[index::count]
+
+def record_counts(filenames, compression = 'NONE'):
+    """Records in each of filenames, from the index preprocess_data.py writes
+    if it covers them and by reading the shards otherwise."""
+    counts = indexed_counts(filenames)
+    if counts is not None:
+        return counts
+    return [int(read_records([f], compression, interleave = 1).reduce(0, lambda n, _: n + 1)) for f in filenames]
+
+def distributed_dataset(strategy, filenames, labels, global_batch_size, **kwargs):
+    """Repeating get_multitask_dataset over each worker's share of filenames,
+    batched to the per-replica batch size."""
+    def _dataset_fn(context):
+        files = worker_files(filenames, context.input_pipeline_id, context.num_input_pipelines)
+        batch_size = context.get_per_replica_batch_size(global_batch_size)
+        return get_multitask_dataset(files, labels, **dict(kwargs, batch_size = batch_size)).repeat()
+    return strategy.distribute_datasets_from_function(_dataset_fn)
+
+def distributed_step(strategy, step_fn):
+    """One step_fn (model.train_step or test_step) on every replica; returns
+    the first local replica's logs."""
+    @tf.function
+    def _step(iterator):
+        outputs = strategy.run(step_fn, args = (next(iterator),))
+        return tf.nest.map_structure(lambda v: strategy.experimental_local_results(v)[0], outputs)
+    return _step
+
+def barrier(strategy):
+    """Return once every worker has called barrier."""
+    @tf.function
+    def _count():
+        return strategy.run(tf.ones, args = ([],))
+    strategy.reduce("SUM", _count(), axis = None)
+
+def metrics_result(model):
+    # read in cross-replica context, so the same on every worker
+    return {name: float(value) for name, value in model.get_metrics_result().items()}
+
+def fit(model, strategy, train_dataset, steps_per_epoch, epochs, validation_data = None, validation_steps = None,
+        callbacks = ()):
+    """model.fit for datasets from distributed_dataset; returns the last epoch's logs."""
+    callbacks = tf.keras.callbacks.CallbackList(list(callbacks), add_history = True, model = model,
+        epochs = epochs, steps = steps_per_epoch)
+    train_step = distributed_step(strategy, model.train_step)
+    test_step = distributed_step(strategy, model.test_step)
+    iterator = iter(train_dataset)
+
+    model.stop_training = False
+    logs = {}
+    callbacks.on_train_begin()
+    for epoch in range(epochs):
+        model.reset_metrics()
+        callbacks.on_epoch_begin(epoch)
+        for step in range(steps_per_epoch):
+            callbacks.on_train_batch_begin(step)
+            callbacks.on_train_batch_end(step, train_step(iterator))
+            if model.stop_training:
+                break
+        logs = metrics_result(model)
+
+        if validation_data is not None:
+            model.reset_metrics()
+            val_iterator = iter(validation_data)
+            for _ in range(validation_steps):
+                test_step(val_iterator)
+            logs.update({f"val_{name}": value for name, value in metrics_result(model).items()})
+
+        callbacks.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+    callbacks.on_train_end(logs)
+    return logs
+
+def save_model(model, path, chief):
+    """model.save on every worker, since Keras 2 saving under a multi-worker
+    strategy can run collectives; only the first worker's copy is kept."""
+    if chief:
+        model.save(path)
+        return
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        model.save(os.path.join(tmp_dir, Path(path).name))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def main():
+    parser = ArgumentParser(
+        prog = "train_distributed.py",
+        description = "Data-parallel multi-worker training of a shared backbone with one head per outcome"
+    )
+
+    add_training_arguments(parser)
+    parser.add_argument("--backbone", action = "store", choices = ['resnet', 'transformer'], default = 'resnet')
+    parser.add_argument("--num-heads", action = "store", type = int, default = 3)
+    parser.add_argument("--patch-size", action = "store", type = int, default = 0)
+    parser.add_argument("--embed-dim", action = "store", type = int, default = 64)
+    parser.add_argument("--head-size", action = "store", type = int, default = 5000)
+    parser.add_argument("--attention", action = "store", choices = ['full', 'local', 'linear'], default = 'full')
+    parser.add_argument("--window", action = "store", type = int, default = 250)
+    parser.add_argument("--steps-per-epoch", action = "store", type = int,
+        help = "global batches per epoch (default: training records / global batch size)")
+    parser.add_argument("--validation-steps", action = "store", type = int,
+        help = "global batches per validation pass (default: validation records / global batch size)")
+    parser.add_argument("--local-workers", action = "store", type = int,
+        help = "run this many CPU-only workers on localhost instead of one worker per SLURM task")
+    parser.add_argument("--port", action = "store", type = int,
+        help = "first port for the workers on each SLURM node (default: from SLURM_JOB_ID)")
+    parser.add_argument("--communication", action = "store", choices = list(COMMUNICATION), default = 'auto')
+    args = parser.parse_args()
+
+    if "TF_CONFIG" not in os.environ:
+        if args.local_workers:
+            sys.exit(run_local_workers(args.local_workers))
+        if int(os.environ.get("SLURM_NTASKS", 1)) > 1:
+            port = args.port or 20000 + int(os.environ.get("SLURM_JOB_ID", 0)) % 10000
+            os.environ["TF_CONFIG"] = tf_config(*slurm_cluster(port))
+
+    # before any other TensorFlow op
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options = tf.distribute.experimental.CommunicationOptions(
+            implementation = COMMUNICATION[args.communication]))
+    resolver = strategy.cluster_resolver
+    chief = not resolver.task_type or resolver.task_id == 0
+    global_batch_size = args.batch_size * strategy.num_replicas_in_sync
+
+    data_path = Path(args.data)
+    train_recs = sorted(data_path.glob("train*.tfrecords"))
+    val_recs = sorted(data_path.glob("val*.tfrecords"))
+    steps_per_epoch = args.steps_per_epoch or max(sum(record_counts(train_recs, args.compression))
+        // global_batch_size, 1)
+    validation_steps = args.validation_steps or max(sum(record_counts(val_recs, args.compression))
+        // global_batch_size, 1)
+    if chief:
+        print(f"{strategy.num_replicas_in_sync} replicas, global batch {global_batch_size}, "
+            f"{steps_per_epoch} steps per epoch")
+
+    augment = augment_options(args)
+    dataset_args = dataset_options(args, train_recs, augment)
+    train_dataset = distributed_dataset(strategy, train_recs, args.tasks, global_batch_size, cache = args.cache,
+        **dataset_args)
+    val_dataset = distributed_dataset(strategy, val_recs, args.tasks, global_batch_size, shuffle = False,
+        cache = args.cache, **dataset_args)
+
+    if args.backbone == 'transformer':
+        backbone = partial(transformer_backbone, num_heads = args.num_heads, patch_size = args.patch_size,
+            embed_dim = args.embed_dim, head_size = args.head_size, attention = args.attention, window = args.window)
+    else:
+        backbone = resnet_backbone
+
+    # the precision policy applies; with Keras 3 jit_compile is only used by Keras' own fit
+    jit_compile = set_training_mode(args.training_mode)
+    with strategy.scope():
+        model = build_model(args.tasks, parse_loss_weights(args), jit_compile,
+            input_shape(augment) if augment else (N_SAMPLES, N_LEADS), backbone)
+        if KERAS_3:
+            model.optimizer.build(model.trainable_variables)
+
+    callbacks = [
+        tf.keras.callbacks.TerminateOnNaN(),
+        EpochTimer(),
+        tf.keras.callbacks.ReduceLROnPlateau(),
+    ]
+    if chief:
+        model.summary()
+        output_path = make_checkpoint_dir("data/models", args.model_name)
+        print(f"Model: {args.model_name} Run Path: {output_path}")
+        callbacks += [
+            tf.keras.callbacks.ModelCheckpoint(f"{output_path}/model.keras", save_best_only=True),
+            tf.keras.callbacks.CSVLogger(f"data/models/{args.model_name}-history.csv")
+        ]
+    elif not KERAS_3:
+        # Keras 2 checkpoints on every worker for the same reason as save_model
+        callbacks.append(tf.keras.callbacks.ModelCheckpoint(os.path.join(tempfile.mkdtemp(), "model.keras"),
+            save_best_only=True))
+
+    if KERAS_3:
+        fit(model, strategy, train_dataset, steps_per_epoch, args.epochs, val_dataset, validation_steps, callbacks)
+    else:
+        model.fit(train_dataset, epochs=args.epochs, steps_per_epoch=steps_per_epoch, validation_data=val_dataset,
+            validation_steps=validation_steps, callbacks=callbacks)
+    save_model(model, f"data/models/{args.model_name}.keras", chief)
+    if chief and augment:
+        save_config(augment_file("data/models", args.model_name), augment)
+    # a worker exiting while the others are still connected aborts their
+    # collectives, so they wait for the first one to finish saving
+    barrier(strategy)
+
+if __name__ == "__main__":
+    main()
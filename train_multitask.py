@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Train one ResNet backbone with a head per outcome, so a single pass over the
+# TFRecords serves every target. Labels that are NaN (most lab values and
+# hospital_expire_flag) are masked out of their head's loss with a zero
+# sample weight rather than dropping the ECG.
+
+import tensorflow as tf
+from tensorflow.keras import layers
+from pathlib import Path
+from argparse import ArgumentParser
+
+from ecg_pipeline import get_multitask_dataset, dataset_stats, parse_time
+from ecg_models import make_checkpoint_dir, resnet_backbone
+from ecg_training import TRAINING_MODES, set_training_mode, EpochTimer, profile_training
+from ecg_records import FORMATS, COMPRESSION, NORMALIZATIONS, N_SAMPLES, N_LEADS
+from ecg_augment import augment_config, input_shape, augment_file, save_config
+
+# task: (output activation, loss, metrics, valid label range)
+TASKS = {
+    'age': (None, 'mse', ['mae'], (None, 90.0)),
+    'gender': ('sigmoid', 'binary_crossentropy', ['accuracy', 'auc'], (None, None)),
+    'potassium': (None, 'mse', ['mae'], (None, None)),
+    'sodium': (None, 'mse', ['mae'], (None, None)),
+    'hospital_expire_flag': ('sigmoid', 'binary_crossentropy', ['accuracy', 'auc'], (None, None)),
+}
+
+def _metric(name):
+    # a fresh AUC instance per head, since metric objects hold state
+    return tf.keras.metrics.AUC() if name == 'auc' else name
+
+def build_model(tasks, loss_weights = None, jit_compile = False, shape = (N_SAMPLES, N_LEADS), backbone = resnet_backbone):
+    """Compiled model with a head per task on backbone(input_layer)."""
+    input_layer = tf.keras.layers.Input(shape=shape, name="input")
+    features = backbone(input_layer)
+
+    outputs = {}
+    for task in tasks:
+        activation = TASKS[task][0]
+        # heads stay float32 under a mixed precision policy
+        outputs[task] = layers.Dense(1, activation = activation, name = task, dtype = 'float32')(features)
+
+    model = tf.keras.models.Model(input_layer, outputs)
+    model.compile(
+        optimizer='adam',
+        loss={task: TASKS[task][1] for task in tasks},
+        loss_weights=loss_weights,
+        weighted_metrics={task: [_metric(m) for m in TASKS[task][2]] for task in tasks},
+        jit_compile=jit_compile,
+    )
+    return model
+
+def add_training_arguments(parser):
+    """The data, label and model options shared with train_distributed.py."""
+    parser.add_argument("--data", action = "store", default = "/scratch/ajb5d/ecg/tfrecords/")
+    parser.add_argument("--tasks", action = "store", nargs = "+", choices = list(TASKS), default = list(TASKS))
+    parser.add_argument("--loss-weight", action = "append", default = [], metavar = "TASK=WEIGHT")
+    parser.add_argument("--batch-size", action = "store", type = int, default = 64)
+    parser.add_argument("--epochs", action = "store", type = int, default = 50)
+    parser.add_argument("--format", action = "store", choices = FORMATS, default = 'float32')
+    parser.add_argument("--compression", action = "store", choices = COMPRESSION, default = 'NONE')
+    parser.add_argument("--normalize", action = "store", choices = NORMALIZATIONS, default = 'zscore')
+    parser.add_argument("--cache", action = "store",
+        help = "cache parsed examples: 'memory', 'auto' or a directory (see ecg_pipeline.get_dataset)")
+    parser.add_argument("--training-mode", action = "store", choices = list(TRAINING_MODES), default = 'float32')
+    parser.add_argument("--model-name", action = "store", default = "resnet-multitask")
+    parser.add_argument("--crop-seconds", action = "store", type = float,
+        help = "train on random crops of this length and validate on the center crop (see ecg_augment.py)")
+    parser.add_argument("--sample-rate", action = "store", type = int, help = "decimate from 500 Hz to this rate")
+    parser.add_argument("--lead-dropout", action = "store", type = float, help = "probability of zeroing each lead")
+    parser.add_argument("--jitter", action = "store", type = float, help = "std of the per-lead log amplitude scale")
+
+def parse_loss_weights(args):
+    loss_weights = {task: 1.0 for task in args.tasks}
+    for item in args.loss_weight:
+        task, weight = item.split("=")
+        loss_weights[task] = float(weight)
+    return loss_weights
+
+def augment_options(args):
+    if all(v is None for v in (args.crop_seconds, args.sample_rate, args.lead_dropout, args.jitter)):
+        return None
+    return augment_config(crop_seconds = args.crop_seconds, sample_rate = args.sample_rate,
+        lead_dropout = args.lead_dropout, jitter = args.jitter)
+
+def dataset_options(args, train_recs, augment):
+    """get_multitask_dataset keyword arguments other than the files, labels,
+    shuffle and cache."""
+    return dict(
+        ranges = {task: TASKS[task][3] for task in args.tasks},
+        fmt = args.format,
+        compression = args.compression,
+        batch_size = args.batch_size,
+        augment = augment,
+        normalize = args.normalize,
+        global_stats = dataset_stats(train_recs, args.compression) if args.normalize == 'global' else None,
+    )
+
+def main():
+    parser = ArgumentParser(
+        prog = "train_multitask.py",
+        description = "Train a shared ResNet backbone with one head per outcome"
+    )
+
+    add_training_arguments(parser)
+    parser.add_argument("--profile", action = "store_true",
+        help = "record input wait vs compute per step in the run directory (see ecg_training.StepProfiler)")
+    parser.add_argument("--trace-steps", action = "store", type = int, nargs = 2, metavar = ("START", "STOP"),
+        help = "with --profile, also capture a profiler trace of these training steps")
+    args = parser.parse_args()
+
+    data_path = Path(args.data)
+    train_recs = sorted(data_path.glob("train*.tfrecords"))
+    val_recs = sorted(data_path.glob("val*.tfrecords"))
+
+    loss_weights = parse_loss_weights(args)
+    augment = augment_options(args)
+    dataset_args = dataset_options(args, train_recs, augment)
+    train_dataset = get_multitask_dataset(train_recs, args.tasks, cache = args.cache, **dataset_args)
+    val_dataset = get_multitask_dataset(val_recs, args.tasks, shuffle = False, cache = args.cache, **dataset_args)
+
+    jit_compile = set_training_mode(args.training_mode)
+    model = build_model(args.tasks, loss_weights, jit_compile, input_shape(augment) if augment else (N_SAMPLES, N_LEADS))
+    model.summary()
+
+    output_path = make_checkpoint_dir("data/models", args.model_name)
+    print(f"Model: {args.model_name} Run Path: {output_path}")
+
+    callbacks = [
+        tf.keras.callbacks.TerminateOnNaN(),
+        EpochTimer(),
+        tf.keras.callbacks.ReduceLROnPlateau(),
+        tf.keras.callbacks.ModelCheckpoint(f"{output_path}/model.keras", save_best_only=True),
+        tf.keras.callbacks.CSVLogger(f"data/models/{args.model_name}-history.csv")
+    ]
+    if args.profile:
+        parse_seconds = parse_time(train_recs, args.tasks, args.format, args.compression, args.normalize,
+            dataset_args['global_stats'])
+        profiler = profile_training(train_dataset, output_path, parse_seconds, args.trace_steps)
+        callbacks.insert(2, profiler)
+
+    model.fit(train_dataset, epochs=args.epochs, validation_data=val_dataset, callbacks=callbacks)
+    model.save(f"data/models/{args.model_name}.keras")
+    if augment:
+        # score_ecgs.py crops and resamples with the same settings
+        save_config(augment_file("data/models", args.model_name), augment)
+
+if __name__ == "__main__":
+    main()
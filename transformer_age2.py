@@ -5,98 +5,61 @@
 import tensorflow as tf
 import numpy as np
 from pathlib import Path
-from datetime import datetime
 import os
 
+from ecg_pipeline import get_dataset, parse_time
+from ecg_models import transformer_backbone, make_checkpoint_dir
+from ecg_training import set_training_mode, EpochTimer, profile_training
+
 
 DATA_PATH = Path("/scratch/ajk4yq/ecg/tfrecords/")
 TRAIN_RECS = list(DATA_PATH.glob("train*.tfrecords"))
 VAL_RECS = list(DATA_PATH.glob("val*.tfrecords"))
 
 
-BATCH_SIZE = 8
-
-record_format = {
-    'ecg/data': tf.io.FixedLenSequenceFeature([], tf.float32, allow_missing=True),
-    'age': tf.io.FixedLenFeature([], tf.float32),
-    'gender': tf.io.FixedLenFeature([], tf.int64),
-}
-
-def _parse_record(record):
-    example = tf.io.parse_single_example(record, record_format)
-    ecg_data = tf.reshape(example['ecg/data'], [5000,12])
-    label = example['age']
-    return ecg_data, label
+BATCH_SIZE = int(os.environ.get("ECG_BATCH_SIZE", 8))
 
-def drop_na_ages(x,y):
-    return not tf.math.reduce_any(tf.math.is_nan(y))
+# Encoder front end and attention, see ecg_models.transformer_encoder. The
+# defaults are the original model: full attention over all 5000 timesteps.
+# ECG_PATCH_SIZE=20 ECG_HEAD_SIZE=64 attends over 250 patch embeddings instead;
+# ECG_ATTENTION=local or linear avoids the full attention matrix altogether.
+PATCH_SIZE = int(os.environ.get("ECG_PATCH_SIZE", 0))
+EMBED_DIM = int(os.environ.get("ECG_EMBED_DIM", 64))
+HEAD_SIZE = int(os.environ.get("ECG_HEAD_SIZE", 5000))
+ATTENTION = os.environ.get("ECG_ATTENTION", "full")
+WINDOW = int(os.environ.get("ECG_WINDOW", 250))
 
-def age_lt_90(x,y):
-    return tf.math.reduce_all(tf.math.less_equal(y, tf.constant([90.0])))
+# float32 (default), xla, mixed_float16 or mixed_bfloat16, see ecg_training.py
+JIT_COMPILE = set_training_mode(os.environ.get("ECG_TRAINING_MODE", "float32"))
 
-def load_dataset(filenames):
-    ignore_order = tf.data.Options()
-    ignore_order.experimental_deterministic = False
-    dataset = tf.data.TFRecordDataset(filenames)
-    dataset = dataset.with_options(ignore_order)
-    dataset = dataset.map(_parse_record, num_parallel_calls=tf.data.AUTOTUNE)
-    dataset = dataset.filter(drop_na_ages)
-    dataset = dataset.filter(age_lt_90)
-    return dataset
-
-def get_dataset(filenames, labeled=True):
-    dataset = load_dataset(filenames)
-    dataset = dataset.shuffle(2048)
-    dataset = dataset.prefetch(buffer_size=tf.data.AUTOTUNE)
-    dataset = dataset.batch(BATCH_SIZE)
-    return dataset
+# ECG_PROFILE=1 records input wait vs compute per step in the run directory;
+# ECG_TRACE_STEPS=10,20 also captures a profiler trace of those steps
+PROFILE = os.environ.get("ECG_PROFILE", "0") == "1"
+TRACE_STEPS = [int(s) for s in os.environ["ECG_TRACE_STEPS"].split(",")] if "ECG_TRACE_STEPS" in os.environ else None
 
 
 # In[ ]:
 
 
-train_dataset = get_dataset(TRAIN_RECS)
-val_dataset = get_dataset(VAL_RECS)
+train_dataset = get_dataset(TRAIN_RECS, 'age', batch_size = BATCH_SIZE, max_value = 90.0)
+val_dataset = get_dataset(VAL_RECS, 'age', batch_size = BATCH_SIZE, max_value = 90.0, shuffle = False)
 
 
 # In[ ]:
 
 
-#https://keras.io/examples/timeseries/timeseries_transformer_classification/
-def transformer_encoder(inputs, head_size, num_heads, ff_dim, dropout=0):
-    x = tf.keras.layers.LayerNormalization(epsilon=1e-6)(inputs)
-    x = tf.keras.layers.MultiHeadAttention(key_dim=head_size, num_heads=num_heads,dropout=dropout)(x,x)
-    x = tf.keras.layers.Dropout(dropout)(x)
-    res = x + inputs
-    
-    x = tf.keras.layers.LayerNormalization(epsilon=1e-6)(res)
-    x = tf.keras.layers.Conv1D(filters=ff_dim, kernel_size=1, activation='relu')(x)
-    x = tf.keras.layers.Dropout(dropout)(x)
-    x = tf.keras.layers.Conv1D(filters=inputs.shape[-1], kernel_size=1)(x)
-    return x + res
-    
 input_layer = tf.keras.layers.Input(shape=(5000, 12))
-x = input_layer
-x = transformer_encoder(x, head_size=5000, num_heads=2, ff_dim=4*12, dropout=0)
-x = tf.keras.layers.MaxPooling1D()(x)
-
-x = tf.keras.layers.Flatten()(x)
-x = tf.keras.layers.Dense(128)(x)
-x = tf.keras.layers.BatchNormalization()(x)
-x = tf.keras.layers.Activation('relu')(x)
-x = tf.keras.layers.Dropout(0.5)(x)
-x = tf.keras.layers.Dense(64)(x)
-x = tf.keras.layers.BatchNormalization()(x)
-x = tf.keras.layers.Activation('relu')(x)
-x = tf.keras.layers.Dropout(0.5)(x)
-x = tf.keras.layers.Dense(1)(x)
+x = transformer_backbone(input_layer, num_heads=2, patch_size=PATCH_SIZE, embed_dim=EMBED_DIM,
+    head_size=HEAD_SIZE, attention=ATTENTION, window=WINDOW)
+x = tf.keras.layers.Dense(1, dtype='float32')(x)
 
 model = tf.keras.models.Model(input_layer, x)
 
 model.compile(
     optimizer='adam',
     loss=tf.keras.losses.MeanSquaredError(),
-    metrics=['mse', 'mae']
+    metrics=['mse', 'mae'],
+    jit_compile=JIT_COMPILE
 )
 
 
@@ -109,22 +72,15 @@ model.summary()
 # In[ ]:
 
 
-def make_checkpoint_dir(data_path, label):
-    current_datetime = datetime.now()
-    formatted_datetime = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
-    output_dir = f"{label}-{formatted_datetime}"
-    output_path = f"{data_path}/{output_dir}"
-    
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    
-    return output_path
-
-
+output_path = make_checkpoint_dir("data/models", "transformer-age")
 callbacks = [
     tf.keras.callbacks.TerminateOnNaN(),
+    EpochTimer(),
     tf.keras.callbacks.ReduceLROnPlateau(),
-    tf.keras.callbacks.ModelCheckpoint(make_checkpoint_dir("data/models", "transformer-age"))
+    tf.keras.callbacks.ModelCheckpoint(output_path)
 ]
+if PROFILE:
+    profiler = profile_training(train_dataset, output_path, parse_time(TRAIN_RECS), TRACE_STEPS)
+    callbacks.insert(2, profiler)
 
 model.fit(train_dataset, epochs=10, validation_data=val_dataset, callbacks=callbacks)
\ No newline at end of file